@@ -0,0 +1,645 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import r1
+
+# Benchmarks the report stages of r1.py against an in-memory stand-in for the
+# Sheets API and the databases, fed with synthetic Citas/DTEs of a given size.
+#
+#   python bench.py --sizes 1000 10000 100000
+#   python bench.py --sizes 1000 10000 --save-baseline
+#   python bench.py --sizes 1000 10000 --baseline
+#
+# Many tabs: one per provider, with a low open files limit so a sink that
+# keeps a file open per tab fails instead of passing on a roomy machine.
+#
+#   python bench.py --sizes 30000 --providers 1500 --open-files 256 --output csv
+
+# load_data extracts the five tabs and reads Citas and DTEs back, the other
+# stages are the builders and can be picked with --stages
+STAGES = ['load_data', 'create_catalogo_tabs', 'create_cruce_basico', 'create_company_tabs', 'create_and_copy_rows_to_tabs']
+BASELINE_FILE = 'bench_baseline.json'
+DATE_FROM = '20230501'
+DATE_TO = '20230531'
+FEE = 0.3
+# A stage regresses when it is this much slower than the baseline, ignoring
+# differences below MIN_SECONDS, or when it makes more API calls
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+
+
+# Synthetic data
+
+def generate(citas_count, seed=1, provider_count=None):
+    rng = random.Random(seed)
+    location_count = max(1, min(40, citas_count // 5000 + 1))
+    provider_count = provider_count or max(5, min(2000, int(math.sqrt(citas_count) * 1.5)))
+    locations = [f"Local {i + 1}" for i in range(location_count)]
+    companies = {location: (f"Empresa {location}", f"76{100000 + i}-{i % 10}") for i, location in enumerate(locations)}
+
+    providers = {location: [] for location in locations}
+    for i in range(provider_count):
+        location = locations[i % location_count]
+        providers[location].append({
+            'id': i + 1,
+            'name': f"Prestador {i + 1}",
+            'rut': f"{10000000 + i * 7919}-{'0123456789K'[i % 11]}",
+        })
+    # A few providers take most of the bookings of each location
+    weights = {location: [1 / (rank + 1) ** 0.8 for rank in range(len(items))] for location, items in providers.items()}
+    location_weights = [len(providers[location]) for location in locations]
+
+    start = r1.datetime.datetime.combine(r1.parse_date(DATE_FROM), r1.datetime.time())
+    minutes = (r1.parse_date(DATE_TO) - start.date()).days * 24 * 60
+    citas, dtes, errores, transacciones = [], [], [], []
+    paid_on = {}
+    payment_id = 100000
+    booking_id = 500000
+    tready_id = 900000
+    while len(citas) < citas_count:
+        payment_id += 1
+        location = rng.choices(locations, location_weights)[0]
+        when = start + r1.datetime.timedelta(minutes=rng.randrange(minutes))
+        fecha = f"{when:%Y-%m-%d %H:%M}"
+        paid_on[payment_id] = f"{when:%Y%m%d}"
+        client_id = rng.randrange(1, citas_count // 3 + 2)
+        items = rng.choices([1, 2, 3], [0.75, 0.2, 0.05])[0]
+        amounts = {}
+        for provider in rng.choices(providers[location], weights[location], k=items):
+            booking_id += 1
+            price = rng.randrange(16, 120) * 500
+            service_id = rng.randrange(1, 60)
+            citas.append([payment_id, fecha, location, provider['id'], provider['name'], booking_id, price, 'confirmed',
+                          client_id, f"Cliente {client_id}", service_id, f"Servicio {service_id}"])
+            key = (provider['name'], provider['rut'])
+            amounts[key] = amounts.get(key, 0) + price
+
+        issued = f"{when + r1.datetime.timedelta(hours=2):%Y-%m-%d %H:%M}"
+        for (name, rut), amount in amounts.items():
+            if rng.random() < 0.85:
+                tready_id += 1
+                dtes.append([f"{payment_id}-{rut}", payment_id, tready_id, issued, 'boleta_honorarios', rut, name,
+                             f"{client_id}-0", f"Cliente {client_id}", amount, f"'{rng.randrange(1, 99999)}",
+                             f"https://dte.example.com/{tready_id}.pdf"])
+            elif rng.random() < 0.5:
+                errores.append([f"{payment_id}-{name}", payment_id, f"{when:%Y%m%d %H:%M}", rut, name,
+                                rng.choice(['RUT no autorizado', 'Timeout del SII', 'Folio duplicado'])])
+        total = sum(amounts.values())
+        if rng.random() < 0.7:
+            tready_id += 1
+            name, rut = companies[location]
+            dtes.append([f"{payment_id}-{rut}", payment_id, tready_id, issued, 'boleta', rut, name,
+                         f"{client_id}-0", f"Cliente {client_id}", total, f"'{rng.randrange(1, 99999)}",
+                         f"https://dte.example.com/{tready_id}.pdf"])
+        if rng.random() < 0.95:
+            transacciones.append([payment_id, payment_id * 10, f"POS-{payment_id}", total, rng.choice([0, 0, 0, 1000, 2000]), fecha])
+
+    emisores = [[p['name'], p['rut']] for items in providers.values() for p in items]
+    emisores += [list(company) for company in companies.values()]
+    # Same order as the queries
+    citas.sort(key=lambda row: (row[1], row[0]), reverse=True)
+    dtes.sort(key=lambda row: row[1], reverse=True)
+    errores.sort(key=lambda row: (row[0], row[2]))
+    transacciones.sort(key=lambda row: row[5], reverse=True)
+    return {
+        'citas': citas[:citas_count],
+        'dtes': dtes,
+        'errores': errores,
+        'transacciones': transacciones,
+        'emisores': emisores,
+        'paid_on': paid_on,
+        'ruts': [f"{companies[location][1]}/{location}" for location in locations[:3]],
+    }
+
+
+# Databases
+
+HEADERS = {
+    'dtes': ['vlookup_id', 'payment_id', 'tready_id', 'fecha_emision', 'tipo_dte', 'emisor_rut', 'emisor_nombre',
+             'receptor_rut', 'receptor_nombre', 'monto', 'folio', 'pdf'],
+    'citas': ['payment_id', 'booking_start_time', 'location', 'provider_id', 'provider_name', 'booking_id', 'booking_price',
+              'booking_status', 'client_id', 'client_name', 'service_id', 'service_name'],
+    'errores': ['vlookup_id', 'payment_id', 'updated_at', 'issuer_identification', 'issuer_name', 'error'],
+    'transacciones': ['payment_id', 'transaction_id', 'external_reference', 'amount', 'tip', 'payment_date'],
+    'emisores': ['issuer_name', 'rut'],
+}
+
+# Tells the five query shapes apart by a fragment of their SQL
+QUERY_MARKERS = [
+    ('-- Búsqueda DTEs', 'dtes'),
+    ('-- Búsqueda Citas', 'citas'),
+    ('-- errores', 'errores'),
+    ('from transactions t', 'transacciones'),
+    ('-- Búsqueda Emisores', 'emisores'),
+]
+
+# Tables behind each high-water mark query. The fake marks a day with the
+# number of rows paid that day and a digest of them.
+WATERMARK_TABLES = [
+    ('-- Marcas pagos y DTEs', ['dtes', 'errores']),
+    ('-- Marcas citas', ['citas']),
+    ('-- Marcas transacciones', ['transacciones']),
+]
+
+# Column with the payment id of each query's rows. The queries filter their
+# date range on the day of the payment (a booking's start is its payment date),
+# and so does the fake, so sharded and cached extractions get only their days.
+PAYMENT_COLUMNS = {
+    'citas': 0,
+    'dtes': 1,
+    'errores': 1,
+    'transacciones': 0,
+}
+
+# Column standing in for the hidden sort_key of queries by day
+SORT_KEY_COLUMNS = {
+    'citas': 1,
+    'transacciones': 5,
+}
+
+def query_range(params):
+    return tuple(value if isinstance(value, r1.datetime.date) else r1.parse_date(value)
+                 for value in (params['date_from'], params['date_to']))
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.data = connection.data
+        self.latency = connection.latency
+        self.rows = []
+        self.description = None
+        self.rowcount = -1
+        self.itersize = 2000
+
+    def execute(self, query, params=None):
+        # The tready session's statement handling is accepted as is. Its temp
+        # table sets the date range of the prepared statements run after it.
+        words = query.split()
+        if words[0] in ('create', 'analyze', 'deallocate'):
+            if params:
+                self.connection.range = query_range(params)
+            return
+        if words[0] == 'prepare':
+            self.connection.prepared[words[1]] = query
+            return
+        date_range = query_range(params) if isinstance(params, dict) else self.connection.range
+        if words[0] == 'execute':
+            query = self.connection.prepared[words[1]]
+        time.sleep(self.latency)
+        for marker, names in WATERMARK_TABLES:
+            if marker in query:
+                self.rows = self.marks(names, date_range)
+                self.description = [('day',), ('rows',), ('digest',)]
+                return
+        for marker, name in QUERY_MARKERS:
+            if marker in query:
+                sort_key, by_day = 'as sort_key' in query, 'as cache_day' in query
+                self.rows = self.select(name, date_range, sort_key, by_day)
+                self.description = [(header,) for header in HEADERS[name] + ['sort_key'] * sort_key + ['cache_day'] * by_day]
+                return
+        raise Exception(f"Consulta desconocida: {query[:80]}")
+
+    def marks(self, names, date_range):
+        paid_on = self.data['paid_on']
+        days = {}
+        for name in names:
+            column = PAYMENT_COLUMNS[name]
+            for row in self.data[name]:
+                days.setdefault(paid_on[row[column]], []).append(json.dumps(row, default=str))
+        first, last = (f"{day:%Y%m%d}" for day in date_range) if date_range else ('', '~')
+        return iter([(day, len(rows), hashlib.md5(''.join(sorted(rows)).encode()).hexdigest())
+                     for day, rows in sorted(days.items()) if first <= day < last])
+
+    def select(self, name, date_range, sort_key, by_day):
+        rows = self.data[name]
+        if name not in PAYMENT_COLUMNS or date_range is None:
+            return iter(rows)
+        column = PAYMENT_COLUMNS[name]
+        paid_on = self.data['paid_on']
+        first, last = (f"{day:%Y%m%d}" for day in date_range)
+        rows = (row for row in rows if first <= paid_on[row[column]] < last)
+        if sort_key or by_day:
+            keys = [SORT_KEY_COLUMNS[name]] if sort_key else []
+            return (list(row) + [row[key] for key in keys] + [paid_on[row[column]]] * by_day for row in rows)
+        return rows
+
+    def fetchall(self):
+        return [tuple(row) for row in self.rows]
+
+    def fetchmany(self, size=None):
+        return [tuple(row) for _, row in zip(range(size or self.itersize), self.rows)]
+
+    def close(self):
+        pass
+
+class FakeConnection:
+
+    def __init__(self, data, latency):
+        self.data = data
+        self.latency = latency
+        self.prepared = {}
+        self.range = None
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+class FakeConnectionPool:
+    data = None
+    latency = 0.0
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        pass
+
+    def getconn(self):
+        return FakeConnection(self.data, self.latency)
+
+    def putconn(self, conn, key=None, close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+
+# Sheets API
+
+def parse_range(range_name):
+    # 'Tab!B3:D' -> (tab, first row, first column, last row, last column), 0-based and None when open
+    tab, _, cells = range_name.rpartition('!')
+    if not tab:
+        return cells, 0, 0, None, None
+    bounds = []
+    for part in (cells.split(':') + [''])[:2]:
+        letters = part.rstrip('0123456789')
+        digits = part[len(letters):]
+        column = None
+        if letters:
+            column = 0
+            for letter in letters:
+                column = column * 26 + ord(letter) - ord('A') + 1
+            column -= 1
+        bounds.append((int(digits) - 1 if digits else None, column))
+    (first_row, first_column), (last_row, last_column) = bounds
+    if ':' not in cells:
+        last_row, last_column = first_row, first_column
+    return tab, first_row or 0, first_column or 0, last_row, last_column
+
+# Rows of a new tab in Sheets
+GRID_ROWS = 1000
+
+class FakeRequest:
+
+    def __init__(self, api, kind, body, handler):
+        self.api = api
+        self.kind = kind
+        self.methodId = 'sheets.spreadsheets.' + kind.replace('spreadsheets.', '')
+        self.body = body
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        time.sleep(self.api.latency)
+        result = self.handler()
+        sent = len(json.dumps(self.body, default=str)) if self.body is not None else 0
+        received = len(json.dumps(result, default=str))
+        with self.api.lock:
+            self.api.calls[self.kind] = self.api.calls.get(self.kind, 0) + 1
+            self.api.bytes_sent += sent
+            self.api.bytes_received += received
+        return result
+
+class FakeSheetsApi:
+    # Keeps one spreadsheet in memory. Reads return what Sheets shows for
+    # plain values; formulas come back as written, they are not evaluated.
+    # New tabs have 1000 rows until values are written past them, and requests
+    # that reach past the rows of a tab fail like they do in Sheets.
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.grids = {}
+        self.sheet_ids = {}
+        self.row_counts = {}
+        self.next_sheet_id = 1
+        self.rules = {}
+        self.calls = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def counters(self):
+        with self.lock:
+            return sum(self.calls.values()), self.bytes_sent, self.bytes_received
+
+    def write(self, range_name, values):
+        tab, row, column, _, _ = parse_range(range_name)
+        grid = self.grids.setdefault(tab, [])
+        self.row_counts[tab] = max(self.row_counts.get(tab, GRID_ROWS), row + len(values))
+        while len(grid) < row + len(values):
+            grid.append([])
+        for i, cells in enumerate(values):
+            target = grid[row + i]
+            if len(target) < column + len(cells):
+                target.extend([''] * (column + len(cells) - len(target)))
+            target[column:column + len(cells)] = cells
+
+    def clear(self, range_name):
+        tab, first_row, first_column, last_row, last_column = parse_range(range_name)
+        grid = self.grids.get(tab, [])
+        for cells in grid[first_row:None if last_row is None else last_row + 1]:
+            end = len(cells) if last_column is None else min(len(cells), last_column + 1)
+            cells[first_column:end] = [''] * max(0, end - first_column)
+        while grid and not any(v != '' for v in grid[-1]):
+            grid.pop()
+
+    def read(self, range_name):
+        tab, first_row, first_column, last_row, last_column = parse_range(range_name)
+        rows = []
+        for cells in self.grids.get(tab, [])[first_row:None if last_row is None else last_row + 1]:
+            cells = cells[first_column:None if last_column is None else last_column + 1]
+            cells = [r1.normalize_cell(v) for v in cells]
+            while cells and cells[-1] == '':
+                cells.pop()
+            rows.append(cells)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    # Resource chain of the discovery client
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return FakeValues(self)
+
+    def get(self, spreadsheetId, fields=None, **kwargs):
+        def handler():
+            with self.lock:
+                return {'sheets': [{'properties': {'title': title, 'sheetId': sheet_id}, 'conditionalFormats': list(self.rules.get(sheet_id, []))}
+                                   for title, sheet_id in self.sheet_ids.items()]}
+        return FakeRequest(self, 'spreadsheets.get', None, handler)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def handler():
+            replies = []
+            with self.lock:
+                titles = [r['addSheet']['properties']['title'] for r in body['requests'] if 'addSheet' in r]
+                for title in titles:
+                    if title in self.sheet_ids:
+                        raise r1.HttpError(r1.httplib2.Response({'status': 400}),
+                                           f'A sheet with the name "{title}" already exists.'.encode())
+                for request in body['requests']:
+                    if 'addSheet' in request:
+                        title = request['addSheet']['properties']['title']
+                        self.sheet_ids[title] = self.next_sheet_id
+                        self.next_sheet_id += 1
+                        replies.append({'addSheet': {'properties': {'title': title, 'sheetId': self.sheet_ids[title]}}})
+                    else:
+                        self.check_grid(request)
+                        if 'addConditionalFormatRule' in request:
+                            rule = request['addConditionalFormatRule']['rule']
+                            self.rules.setdefault(rule['ranges'][0]['sheetId'], []).append(rule)
+                        replies.append({})
+            return {'replies': replies}
+        return FakeRequest(self, 'batchUpdate', body, handler)
+
+    def check_grid(self, request):
+        ranges = [request['repeatCell']['range']] if 'repeatCell' in request else \
+            request['addConditionalFormatRule']['rule']['ranges'] if 'addConditionalFormatRule' in request else []
+        titles = {sheet_id: title for title, sheet_id in self.sheet_ids.items()}
+        for grid_range in ranges:
+            title = titles[grid_range['sheetId']]
+            rows = self.row_counts.get(title, GRID_ROWS)
+            if grid_range.get('endRowIndex', 0) > rows:
+                raise r1.HttpError(r1.httplib2.Response({'status': 400}),
+                                   f"Range ('{title}'!{grid_range['endRowIndex']}) exceeds grid limits. Max rows: {rows}".encode())
+
+class FakeValues:
+
+    def __init__(self, api):
+        self.api = api
+
+    def get(self, spreadsheetId, range, **kwargs):
+        def handler():
+            with self.api.lock:
+                return {'range': range, 'values': self.api.read(range)}
+        return FakeRequest(self.api, 'values.get', None, handler)
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        def handler():
+            with self.api.lock:
+                return {'valueRanges': [{'range': r, 'values': self.api.read(r)} for r in ranges]}
+        return FakeRequest(self.api, 'values.batchGet', None, handler)
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def handler():
+            with self.api.lock:
+                self.api.write(range, body['values'])
+            return {}
+        return FakeRequest(self.api, 'values.update', body, handler)
+
+    def append(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        def handler():
+            with self.api.lock:
+                tab = parse_range(range)[0]
+                self.api.write(f"{tab}!A{len(self.api.grids.get(tab, [])) + 1}", body['values'])
+            return {}
+        return FakeRequest(self.api, 'values.append', body, handler)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def handler():
+            with self.api.lock:
+                for data in body['data']:
+                    self.api.write(data['range'], data['values'])
+            return {}
+        return FakeRequest(self.api, 'values.batchUpdate', body, handler)
+
+    def clear(self, spreadsheetId, range, body=None):
+        def handler():
+            with self.api.lock:
+                self.api.clear(range)
+            return {}
+        return FakeRequest(self.api, 'values.clear', body, handler)
+
+    def batchClear(self, spreadsheetId, body):
+        def handler():
+            with self.api.lock:
+                for range_name in body['ranges']:
+                    self.api.clear(range_name)
+            return {}
+        return FakeRequest(self.api, 'values.batchClear', body, handler)
+
+
+# Measurements
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux, the process peak rather than the current size
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RssSampler:
+    # Polls the resident set size while a stage runs and keeps its peak
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = current_rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+def measure(api, function):
+    calls, sent, received = api.counters()
+    started = time.perf_counter()
+    with RssSampler() as sampler:
+        function()
+        # Writes still in the buffer belong to this stage
+        r1.report.write_buffer.flush()
+    seconds = time.perf_counter() - started
+    after_calls, after_sent, after_received = api.counters()
+    return {
+        'seconds': round(seconds, 4),
+        'calls': after_calls - calls,
+        'bytes_sent': after_sent - sent,
+        'bytes_received': after_received - received,
+        'peak_rss_mb': round(sampler.peak / 2 ** 20, 1),
+    }
+
+def run_size(size, args, work_dir):
+    print(f"Generando {size} citas...")
+    data = generate(size, args.seed, args.providers)
+    FakeConnectionPool.data = data
+    FakeConnectionPool.latency = args.db_latency
+    api = FakeSheetsApi(args.sheets_latency)
+    r1.sheets_api = api
+    r1.configure(no_cache=True, read_quota=10 ** 9, write_quota=10 ** 9, sheets_concurrency=args.sheets_concurrency)
+    r1.report.activate(r1.ReportState('bench'))
+    output_path = os.path.join(work_dir, f"{size}.xlsx" if args.output == 'xlsx' else str(size))
+    r1.report.sink = r1.make_sink(args.output, output_path)
+
+    steps = {
+        'load_data': lambda: (r1.extract_data('1', DATE_FROM, DATE_TO, args.stream), r1.read_citas_and_dtes()),
+        'create_catalogo_tabs': r1.create_catalogo_tabs,
+        'create_cruce_basico': lambda: r1.create_cruce_basico(args.formulas or args.array_formulas, args.array_formulas),
+        'create_company_tabs': lambda: r1.create_company_tabs(data['ruts'], args.formulas or args.array_formulas, args.array_formulas),
+        'create_and_copy_rows_to_tabs': lambda: r1.create_and_copy_rows_to_tabs(FEE, None, args.materialize, args.array_formulas),
+    }
+    results = {}
+    for stage in STAGES:
+        if stage != 'load_data' and stage not in args.stages:
+            continue
+        results[stage] = measure(api, steps[stage])
+        print(f"  {stage:<30} {results[stage]['seconds']:>9.2f}s")
+    r1.report.sink.close()
+    r1.close_connection_pools()
+    return results
+
+def compare(results, baseline):
+    regressions = []
+    for size, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get(size, {}).get(stage)
+            if previous is None:
+                continue
+            slower = current['seconds'] - previous['seconds']
+            if slower > MIN_SECONDS and current['seconds'] > previous['seconds'] * (1 + TOLERANCE):
+                regressions.append((size, stage, 'seconds', previous['seconds'], current['seconds']))
+            if current['calls'] > previous['calls']:
+                regressions.append((size, stage, 'calls', previous['calls'], current['calls']))
+            if current['bytes_sent'] > previous['bytes_sent'] * (1 + TOLERANCE):
+                regressions.append((size, stage, 'bytes_sent', previous['bytes_sent'], current['bytes_sent']))
+    return regressions
+
+def print_table(results):
+    print(f"{'citas':>9}  {'etapa':<30} {'segundos':>9} {'llamadas':>9} {'KB enviados':>12} {'KB recibidos':>13} {'RSS máx MB':>11}")
+    for size, stages in results.items():
+        for stage, r in stages.items():
+            print(f"{size:>9}  {stage:<30} {r['seconds']:>9.2f} {r['calls']:>9} {r['bytes_sent'] / 1024:>12.0f} "
+                  f"{r['bytes_received'] / 1024:>13.0f} {r['peak_rss_mb']:>11.1f}")
+
+def main(args):
+    # The fakes need neither credentials nor the database
+    r1.credentials = object()
+    r1.db_credentials = {key: {'host': 'bench', 'user': '', 'pass': '', 'db': key} for key in ('tready', 'dwh', 'ap')}
+    r1.pool.ThreadedConnectionPool = FakeConnectionPool
+    if args.open_files:
+        # The hard limit too, or the sinks could raise it back
+        resource.setrlimit(resource.RLIMIT_NOFILE, (args.open_files, args.open_files))
+
+    work_dir = tempfile.mkdtemp(prefix='r1_bench_')
+    r1.STATE_DIR = os.path.join(work_dir, 'state')
+    r1.CACHE_DIR = os.path.join(work_dir, 'cache')
+    results = {}
+    try:
+        for size in args.sizes:
+            results[str(size)] = run_size(size, args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Línea base guardada en '{args.save_baseline}'")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        for size, stage, metric, previous, current in regressions:
+            print(f"REGRESIÓN {size} citas, {stage}: {metric} {previous} -> {current}")
+        if regressions:
+            return 1
+        print("Sin regresiones respecto a la línea base")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark de r1.py con Sheets y bases de datos simuladas')
+    parser.add_argument('-n',  '--sizes',        type=int, nargs='+', default=[1000, 10000, 100000], help='Cantidades de citas a generar')
+    parser.add_argument('-e',  '--stages',       nargs='+', default=STAGES[1:], choices=STAGES[1:], help='Etapas a medir además de load_data')
+    parser.add_argument('-o',  '--output',       type=str, default='sheets', choices=list(r1.OUTPUTS), help='Salida del reporte')
+    parser.add_argument('-m',  '--materialize',  action='store_true',     help='Hojas por prestador con valores calculados')
+    parser.add_argument('-fx', '--formulas',     action='store_true',     help='Cruce y hojas por local con fórmulas')
+    parser.add_argument('-af', '--array-formulas', action='store_true',   help='Una fórmula por columna en vez de una por fila')
+    parser.add_argument('-st', '--stream',       action='store_true',     help='Extraer por partes')
+    parser.add_argument('-sc', '--sheets-concurrency', type=int, default=r1.SHEETS_CONCURRENCY, help='Escrituras simultáneas a la API de Sheets')
+    parser.add_argument('-sl', '--sheets-latency', type=float, default=0.0, help='Segundos de latencia simulada por llamada a Sheets')
+    parser.add_argument('-dl', '--db-latency',   type=float, default=0.0,  help='Segundos de latencia simulada por consulta')
+    parser.add_argument('-pr', '--providers',    type=int,                 help='Cantidad de prestadores, una pestaña por cada uno (por defecto según las citas)')
+    parser.add_argument('-of', '--open-files',   type=int,                 help='Límite de archivos abiertos del proceso, para probar reportes con muchas pestañas')
+    parser.add_argument('-sd', '--seed',         type=int, default=1,      help='Semilla de los datos generados')
+    parser.add_argument('-j',  '--json',         type=str,                 help='Guardar los resultados en este archivo JSON')
+    parser.add_argument('-b',  '--baseline',     type=str, nargs='?', const=BASELINE_FILE, help='Comparar con la línea base y marcar regresiones')
+    parser.add_argument('-sb', '--save-baseline', type=str, nargs='?', const=BASELINE_FILE, help='Guardar los resultados como línea base')
+
+    sys.exit(main(parser.parse_args()))
@@ -1,56 +1,627 @@
 from calendar import c
 import re
+import math
+import bisect
 import argparse
-import copy
+import heapq
+import itertools
+import threading
+import contextlib
+import traceback
+import sys
+import os
+import hashlib
+import numbers
+import shutil
+import datetime
+import queue
+import uuid
+import time
+import random
+import socket
+import errno
+import functools
+import collections
+import io
+import gzip
+import zlib
+import cProfile
+import pstats
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from unicodedata import decimal
 import psycopg2
+from psycopg2 import pool
 import pandas as pd
+import numpy as np
 import json
+import csv
 from google.oauth2 import service_account
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+import google_auth_httplib2
+import httplib2
 
 # Set up Google Sheets API credentials
 SERVICE_ACCOUNT_FILE = 'rutificador-384117-fb50f95b19f7.json'
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
-# Load your service account key and create an API client
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-sheets_api = discovery.build('sheets', 'v4', credentials=credentials)
+# The service account key and the API client are loaded on first use, so the
+# module can be imported without them. The client is built from the discovery
+# document bundled with google-api-python-client instead of fetching it, and
+# sends its calls through the transport of the scheduler (see SheetsScheduler).
+credentials = None
+sheets_api = None
+clients_lock = threading.Lock()
+
+def get_credentials():
+    global credentials
+    with clients_lock:
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        return credentials
+
+def get_sheets_api():
+    global sheets_api
+    if sheets_api is None:
+        client_credentials = get_credentials()
+        with clients_lock:
+            if sheets_api is None:
+                sheets_api = discovery.build('sheets', 'v4', credentials=client_credentials, static_discovery=True, cache_discovery=False,
+                                             model=CompactJsonModel())
+    return sheets_api
+
+class CompactJsonModel(JsonModel):
+    # Request bodies as compact UTF-8 JSON, without the spaces after separators
+    # and the \u escapes of every accented letter that json.dumps adds by default
+
+    def serialize(self, body_value):
+        if isinstance(body_value, dict) and 'data' not in body_value and self._data_wrapper:
+            body_value = {'data': body_value}
+        return json.dumps(body_value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+# Spans recorded for --profile: DB queries, Sheets calls and report builders.
+# Until the tracer is enabled span() only hands back the attribute dict.
+class Tracer:
+    METRICS = ('rows', 'cells', 'bytes', 'received', 'retries', 'waited')
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        if not self.enabled:
+            yield attributes
+            return
+        # Time spent in nested spans of the same thread is subtracted to get the span's own time
+        stack = self.local.__dict__.setdefault('stack', [])
+        frame = {'name': name, 'children': 0.0}
+        parent = stack[-1] if stack else None
+        stack.append(frame)
+        started = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            seconds = time.perf_counter() - started
+            stack.pop()
+            if parent:
+                parent['children'] += seconds
+            record = {
+                'name': name,
+                'parent': parent['name'] if parent else None,
+                'thread': threading.current_thread().name,
+                'start': started - self.origin,
+                'seconds': seconds,
+                'self_seconds': seconds - frame['children'],
+                **attributes,
+            }
+            with self.lock:
+                self.spans.append(record)
+
+    def summary(self):
+        totals = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span['name'], {'count': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'max_seconds': 0.0,
+                                                     **{metric: 0 for metric in self.METRICS}})
+            total['count'] += 1
+            total['seconds'] += span['seconds']
+            total['self_seconds'] += span['self_seconds']
+            total['max_seconds'] = max(total['max_seconds'], span['seconds'])
+            for metric in self.METRICS:
+                total[metric] += span.get(metric, 0)
+        return totals
+
+    def table(self):
+        lines = [f"{'span':<32} {'veces':>6} {'total s':>9} {'propio s':>9} {'máx s':>8} {'filas':>9} {'celdas':>10} {'KB':>9} {'KB recib.':>9} {'reintentos':>10} {'cola s':>8}"]
+        for name, t in sorted(self.summary().items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"{name:<32} {t['count']:>6} {t['seconds']:>9.2f} {t['self_seconds']:>9.2f} {t['max_seconds']:>8.2f} "
+                         f"{t['rows']:>9} {t['cells']:>10} {t['bytes'] / 1024:>9.0f} {t['received'] / 1024:>9.0f} {t['retries']:>10} {t['waited']:>8.1f}")
+        return '\n'.join(lines)
+
+    def dump(self, path, other_data=None):
+        # Chrome trace event format, opens in chrome://tracing or Perfetto
+        with self.lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for span in sorted(spans, key=lambda s: s['start']):
+            tid = threads.setdefault(span['thread'], len(threads) + 1)
+            args = {k: v for k, v in span.items() if k not in ('name', 'thread', 'start', 'seconds')}
+            events.append({'name': span['name'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': round(span['start'] * 1e6), 'dur': round(span['seconds'] * 1e6), 'args': args})
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}} for name, tid in threads.items())
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'summary': self.summary(), **(other_data or {})}}, f, default=str)
+
+tracer = Tracer()
+
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with tracer.span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def payload_bytes(request):
+    body = getattr(request, 'body', None)
+    if body is None:
+        return 0
+    if isinstance(body, (str, bytes)):
+        return len(body)
+    return len(json.dumps(body, default=str))
+
+# Sheets API quotas are per minute; 429 and 5xx responses are retried with jittered exponential backoff
+READS_PER_MINUTE = 60
+WRITES_PER_MINUTE = 60
+SHEETS_CONCURRENCY = 4
+MAX_RETRIES = 6
+BACKOFF_BASE = 2.0
+MAX_BACKOFF = 64.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, float(per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Returns how long the caller had to wait for a token
+        started = time.monotonic()
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return now - started
+                time.sleep((1 - self.tokens) / self.rate)
+
+# Transports the Sheets calls can go through (see --transport). httplib2 is
+# what googleapiclient uses on its own and is not thread safe, so every thread
+# keeps its own connection. urllib3 keeps one pool of keep-alive connections
+# shared by all threads. Both look like httplib2.Http to the client and count
+# the bytes each call sends and receives; with --gzip-requests the larger
+# bodies are sent gzipped. Responses come gzipped either way, the client asks
+# for them with accept-encoding.
+TRANSPORTS = ('urllib3', 'httplib2')
+GZIP_MIN_BYTES = 2048
+
+def body_bytes(body):
+    return body.encode('utf-8') if isinstance(body, str) else body
+
+def gzip_body(body, headers):
+    if body is None or len(body) < GZIP_MIN_BYTES:
+        return body
+    body = gzip.compress(body_bytes(body), compresslevel=5)
+    headers['content-encoding'] = 'gzip'
+    headers['content-length'] = str(len(body))
+    return body
+
+class Httplib2Transport:
+
+    def __init__(self, count, gzip_requests=False):
+        self.http = httplib2.Http()
+        self.count = count
+        self.gzip_requests = gzip_requests
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self.gzip_requests:
+            body = gzip_body(body, headers)
+        response, content = self.http.request(uri, method, body=body, headers=headers, **kwargs)
+        # httplib2 hands back the response already decompressed
+        self.count(len(body_bytes(body) or b''), len(content))
+        return response, content
+
+class Urllib3Transport:
+
+    def __init__(self, pool, errors, count, gzip_requests=False):
+        self.pool = pool
+        self.errors = errors
+        self.count = count
+        self.gzip_requests = gzip_requests
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None, **kwargs):
+        headers = dict(headers or {})
+        if self.gzip_requests:
+            body = gzip_body(body, headers)
+        try:
+            # Retries and backoff are left to the scheduler
+            response = self.pool.request(method, uri, body=body, headers=headers, retries=False, decode_content=False)
+        except self.errors as error:
+            raise ConnectionError(str(error)) from error
+        content = response.data
+        self.count(len(body_bytes(body) or b''), len(content))
+        info = {key.lower(): value for key, value in response.headers.items()}
+        if info.pop('content-encoding', None) in ('gzip', 'deflate'):
+            content = zlib.decompress(content, zlib.MAX_WBITS | 32)
+        info['status'] = response.status
+        result = httplib2.Response(info)
+        result.reason = response.reason
+        return result, content
+
+class SheetsScheduler:
+    # Every Sheets request goes through execute(), which waits for quota,
+    # retries transient errors and keeps count of requests, waits, retries and
+    # bytes on the wire
+
+    def __init__(self, reads_per_minute=READS_PER_MINUTE, writes_per_minute=WRITES_PER_MINUTE, max_workers=SHEETS_CONCURRENCY,
+                 transport='urllib3', gzip_requests=False):
+        self.buckets = {'read': TokenBucket(reads_per_minute), 'write': TokenBucket(writes_per_minute)}
+        self.max_workers = max_workers
+        self.transport = transport
+        self.gzip_requests = gzip_requests
+        self.pool = self.pool_errors = None
+        self.pool_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.stats = {kind: {'requests': 0, 'waited': 0.0, 'max_wait': 0.0, 'retries': 0, 'sent': 0, 'received': 0} for kind in self.buckets}
+        self.local = threading.local()
+
+    def http(self):
+        # Credentials are added per thread; with urllib3 the connections underneath are shared
+        if not hasattr(self.local, 'http'):
+            self.local.http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=self.connection())
+        return self.local.http
+
+    def connection(self):
+        if self.transport == 'urllib3':
+            with self.pool_lock:
+                if self.pool is None:
+                    try:
+                        import urllib3
+                        # Writes run on max_workers threads, reads on the builders' threads
+                        self.pool = urllib3.PoolManager(maxsize=self.max_workers * 2, block=True)
+                        self.pool_errors = urllib3.exceptions.HTTPError
+                    except ImportError:
+                        print("urllib3 no está instalado, se usa httplib2 para Sheets")
+                        self.transport = 'httplib2'
+            if self.pool is not None:
+                return Urllib3Transport(self.pool, self.pool_errors, self.count, self.gzip_requests)
+        return Httplib2Transport(self.count, self.gzip_requests)
+
+    def count(self, sent, received):
+        # Calls made outside execute() count too, until execute() resets them
+        self.local.sent = getattr(self.local, 'sent', 0) + sent
+        self.local.received = getattr(self.local, 'received', 0) + received
+
+    def record(self, kind, span):
+        # What the transport counted for the last attempt; requests that never
+        # reach a transport keep the estimate of payload_bytes
+        sent, received = self.local.sent, self.local.received
+        if sent or received:
+            span['bytes'] = sent
+        span['received'] += received
+        with self.stats_lock:
+            self.stats[kind]['sent'] += sent
+            self.stats[kind]['received'] += received
+
+    def execute(self, request, kind='write', cells=0, idempotent=True):
+        # Requests that must not be applied twice are only retried on 429, which
+        # says they were not applied; other errors go back to the caller
+        method = getattr(request, 'methodId', None) or kind
+        with tracer.span(f"sheets.{method.replace('sheets.spreadsheets.', '')}", cells=cells, bytes=payload_bytes(request)) as span:
+            span['retries'] = span['waited'] = span['received'] = 0
+            for attempt in range(MAX_RETRIES + 1):
+                waited = self.buckets[kind].acquire()
+                span['waited'] += waited
+                with self.stats_lock:
+                    stats = self.stats[kind]
+                    stats['requests'] += 1
+                    stats['waited'] += waited
+                    stats['max_wait'] = max(stats['max_wait'], waited)
+                self.local.sent = self.local.received = 0
+                try:
+                    return request.execute(http=self.http())
+                except HttpError as error:
+                    if error.resp.status not in RETRY_STATUS or attempt == MAX_RETRIES or not (idempotent or error.resp.status == 429):
+                        raise
+                    reason = error
+                except (ConnectionError, socket.timeout, httplib2.HttpLib2Error) as error:
+                    self.local.__dict__.pop('http', None)
+                    if attempt == MAX_RETRIES or not idempotent:
+                        raise
+                    reason = error
+                finally:
+                    self.record(kind, span)
+                delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+                with self.stats_lock:
+                    self.stats[kind]['retries'] += 1
+                span['retries'] += 1
+                print(f"Reintentando en {delay:.1f}s: {reason}")
+                time.sleep(delay)
+
+    def summary(self):
+        with self.stats_lock:
+            return '\n'.join(
+                f"Sheets {kind}: {s['requests']} llamadas, {s['retries']} reintentos, "
+                f"espera en cola {s['waited']:.1f}s (máx {s['max_wait']:.1f}s), "
+                f"{s['sent'] / 1024:.0f} KB enviados, {s['received'] / 1024:.0f} KB recibidos"
+                for kind, s in self.stats.items())
+
+sheets_scheduler = SheetsScheduler()
+
+def execute_read(request):
+    return sheets_scheduler.execute(request, 'read')
+
+def execute_write(request, cells=0, idempotent=True):
+    return sheets_scheduler.execute(request, 'write', cells, idempotent)
 
 def get_spreadsheet_id_from_url(url):
     match = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url)
     return match.group(1) if match else None
 
-spreadsheet_id = "AAAAAAAAAA"
 
-citas = dtes = None
+# Upper bounds for a single batchUpdate call
+MAX_BATCH_REQUESTS = 500
+MAX_BATCH_CELLS = 200000
+
+# Requests that add something again every time they are applied. A batchUpdate
+# is applied whole or not at all, so after an error that may have reached the
+# spreadsheet a batch with any of them is read back instead of sent again as is.
+NOT_IDEMPOTENT = ('addSheet', 'addConditionalFormatRule')
+
+def may_have_applied(error):
+    if not isinstance(error, HttpError):
+        return True
+    return error.resp.status >= 500 or (error.resp.status == 400 and 'already exists' in str(error))
+
+def rule_key(rule):
+    # Sheets leaves out the indexes that are zero when it returns a rule
+    ranges = [[r.get(k, 0) for k in ('sheetId', 'startRowIndex', 'endRowIndex', 'startColumnIndex', 'endColumnIndex')]
+              for r in rule.get('ranges', [])]
+    condition = rule.get('booleanRule', {}).get('condition', {})
+    return json.dumps([ranges, condition.get('type'), [v.get('userEnteredValue') for v in condition.get('values', [])]])
+
+class WriteBuffer:
+    # Collects structural requests and value writes and sends them in as few
+    # batchUpdate calls as possible. Tabs added through the buffer get a negative
+    # placeholder sheetId until the addSheet reply tells us the real one.
+
+    def __init__(self):
+        self.clears = []
+        self.requests = []
+        self.values = []
+        self.cells = 0
+        self.sheet_ids = {}
+        self.last_placeholder = 0
+        # Called before every flush sends anything, and after it once everything
+        # buffered so far has been sent
+        self.before_flush = []
+        self.on_flush = []
+
+    def add_sheet(self, tab_name):
+        self.last_placeholder -= 1
+        self.requests.append(({"addSheet": {"properties": {"title": tab_name}}}, self.last_placeholder))
+        return self.last_placeholder
+
+    def add_request(self, request):
+        self.requests.append((request, None))
+
+    def clear(self, range_name):
+        self.clears.append(range_name)
+
+    def add_values(self, tab_name, values, row=1, column='A'):
+        if not values:
+            return
+        width = max(len(r) for r in values) or 1
+        chunk = max(1, MAX_BATCH_CELLS // width)
+        for i in range(0, len(values), chunk):
+            part = values[i:i + chunk]
+            self.values.append({'range': f'{tab_name}!{column}{row + i}', 'values': part})
+            self.cells += len(part) * width
+            if self.cells >= MAX_BATCH_CELLS:
+                self.flush()
+
+    def resolve(self, obj):
+        if isinstance(obj, dict):
+            return {k: (self.sheet_ids.get(v, v) if k == 'sheetId' else self.resolve(v)) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [self.resolve(v) for v in obj]
+        return obj
+
+    def flush(self):
+        for callback in self.before_flush:
+            callback()
+        # New tabs go first, then clears and values, and formatting last: a new
+        # tab only grows past its default 1000 rows once its values are written
+        pending, self.requests = self.requests, []
+        with tracer.span('sheets.flush'):
+            self.flush_requests([r for r in pending if r[1] is not None])
+            self.flush_clears()
+            self.flush_values()
+            self.flush_requests([r for r in pending if r[1] is None])
+        for callback in self.on_flush:
+            callback()
+
+    def flush_clears(self):
+        clears, self.clears = self.clears, []
+        if not clears:
+            return
+        execute_write(get_sheets_api().spreadsheets().values().batchClear(spreadsheetId=report.spreadsheet_id, body={'ranges': clears}))
+
+    def flush_requests(self, pending):
+        # Either addSheet requests, which do not depend on anything else and give
+        # every later request its real sheetIds, or the requests that use them
+        for i in range(0, len(pending), MAX_BATCH_REQUESTS):
+            self.send_requests(pending[i:i + MAX_BATCH_REQUESTS])
+        for k, v in report.tabs.items():
+            if v in self.sheet_ids:
+                report.tabs[k] = self.sheet_ids[v]
 
+    def send_requests(self, batch):
+        idempotent = not any(key in NOT_IDEMPOTENT for request, placeholder in batch for key in request)
+        for attempt in range(MAX_RETRIES + 1):
+            body = {"requests": [self.resolve(r[0]) for r in batch]}
+            try:
+                response = execute_write(get_sheets_api().spreadsheets().batchUpdate(spreadsheetId=report.spreadsheet_id, body=body),
+                                         idempotent=idempotent)
+            except (HttpError, ConnectionError, socket.timeout, httplib2.HttpLib2Error) as error:
+                if idempotent or attempt == MAX_RETRIES or not may_have_applied(error):
+                    raise
+                print(f"Revisando qué cambios alcanzaron a aplicarse: {str(error).strip()}")
+                time.sleep(min(MAX_BACKOFF, BACKOFF_BASE ** attempt))
+                batch = self.unapplied(batch)
+                if not batch:
+                    return
+                continue
+            for (request, placeholder), reply in zip(batch, response.get('replies', [])):
+                if placeholder is not None:
+                    self.sheet_ids[placeholder] = reply["addSheet"]["properties"]["sheetId"]
+            return
+
+    def unapplied(self, batch):
+        # The requests of the batch the spreadsheet does not show yet. Tabs that
+        # are there only need their sheetIds.
+        response = execute_read(get_sheets_api().spreadsheets().get(
+            spreadsheetId=report.spreadsheet_id, fields='sheets(properties(title,sheetId),conditionalFormats)'))
+        sheets = response.get('sheets', [])
+        existing = {sheet['properties']['title']: sheet['properties']['sheetId'] for sheet in sheets}
+        rules = {rule_key(rule) for sheet in sheets for rule in sheet.get('conditionalFormats', [])}
+        missing = []
+        for request, placeholder in batch:
+            if 'addSheet' in request and request['addSheet']['properties']['title'] in existing:
+                self.sheet_ids[placeholder] = existing[request['addSheet']['properties']['title']]
+            elif 'addConditionalFormatRule' in request and rule_key(self.resolve(request)['addConditionalFormatRule']['rule']) in rules:
+                continue
+            else:
+                missing.append((request, placeholder))
+        return missing
+
+    def flush_values(self):
+        pending, self.values = self.values, []
+        self.cells = 0
+        batches = []
+        batch = []
+        cells = 0
+        for data in pending + [None]:
+            if data is not None:
+                size = len(data['values']) * (max(len(r) for r in data['values']) or 1)
+            if batch and (data is None or cells + size > MAX_BATCH_CELLS):
+                batches.append(batch)
+                batch = []
+                cells = 0
+            if data is not None:
+                batch.append(data)
+                cells += size
+
+        # Value batches write disjoint ranges, so they can go out in parallel
+        requests = [
+            (get_sheets_api().spreadsheets().values().batchUpdate(
+                spreadsheetId=report.spreadsheet_id,
+                body={'valueInputOption': 'USER_ENTERED', 'data': batch}
+            ), sum(len(data['values']) * (max(len(r) for r in data['values']) or 1) for data in batch)) for batch in batches
+        ]
+        if len(requests) <= 1:
+            for request, cells in requests:
+                execute_write(request, cells)
+            return
+        with ThreadPoolExecutor(max_workers=sheets_scheduler.max_workers) as executor:
+            for future in [executor.submit(execute_write, request, cells) for request, cells in requests]:
+                future.result()
+
+class ReportState:
+    # Everything that belongs to the report being built: target spreadsheet,
+    # its tabs, the data read for it and its pending writes
+
+    def __init__(self, spreadsheet_id="AAAAAAAAAA", incremental=False):
+        self.spreadsheet_id = spreadsheet_id
+        self.citas = self.dtes = None
+        # Registry of tab contents shared by the builders, keyed by tab name. Every
+        # tab is a read-only Dataset, filled at extraction or read from the sheet.
+        self.datasets = {}
+        # Title -> sheetId of every tab in the spreadsheet. Fetched once per run and
+        # kept up to date by create_tab and the write buffer.
+        self.tabs = {}
+        self.tabs_loaded = False
+        self.write_buffer = WriteBuffer()
+        self.incremental = incremental
+        # Saved hashes of the rows in the sheet, loaded on the first write
+        self.row_hashes = None
+        self.sink = None
+        # Frames returned by the aggregate queries when the report is built with --aggregates
+        self.aggregates = None
+        # Input hashes of the tabs written by earlier runs, None when every tab is rebuilt
+        self.journal = None
+        self.dataset_hashes = {}
+
+class CurrentReport(threading.local):
+    # Gives each thread its own current report, so batch workers can build
+    # several reports at once
+
+    def __init__(self):
+        super().__setattr__('state', ReportState())
+
+    def activate(self, state):
+        super().__setattr__('state', state)
+
+    def __getattr__(self, name):
+        return getattr(self.state, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.state, name, value)
+
+report = CurrentReport()
+
+@traced
 def read_citas_and_dtes():
-    try:
-        global citas, dtes
-        range_name = 'Citas!A:L'
-        result = sheets_api.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-        citas = result.get('values', [])
-        range_name = 'DTEs!A:L'
-        result = sheets_api.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-        dtes = result.get('values', [])
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        return None
+    report.citas, report.dtes = get_datasets(['Citas', 'DTEs'])
+
+def get_datasets(tab_names):
+    # Tabs missing from the registry (no extraction in this run) come from the
+    # sheet in a single batchGet, unformatted so numbers stay numbers
+    missing = [tab_name for tab_name in tab_names if tab_name not in report.datasets]
+    if missing:
+        report.write_buffer.flush()
+        result = execute_read(get_sheets_api().spreadsheets().values().batchGet(
+            spreadsheetId=report.spreadsheet_id, ranges=missing,
+            valueRenderOption='UNFORMATTED_VALUE', dateTimeRenderOption='FORMATTED_STRING'))
+        for tab_name, value_range in zip(missing, result.get('valueRanges', [])):
+            report.datasets[tab_name] = Dataset(value_range.get('values', []))
+    return [report.datasets[tab_name] for tab_name in tab_names]
+
+def get_dataset(tab_name):
+    return get_datasets([tab_name])[0]
 
 #not used
 def tab_exists(tab_name):
-    try:
-        sheet_metadata = sheets_api.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        sheets = sheet_metadata.get('sheets', '')
-        for sheet in sheets:
-            if sheet['properties']['title'] == tab_name:
-                return True
-        return False
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        return False
+    return tab_name in get_tabs()
 
 def format_percentage_column(sheet_name, sheet_id, column_letter, decimal_places, row_count):
     start_range = f"{sheet_name}!{column_letter}1"
@@ -78,10 +649,7 @@ def format_percentage_column(sheet_name, sheet_id, column_letter, decimal_places
         }
     }
 
-    try:
-        sheets_api.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": [format_request]}).execute()
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+    report.write_buffer.add_request(format_request)
 
 def apply_conditional_formatting(sheet_name, sheet_id, column_letter, row_count, fee):
     fee_from = "{:.2f}".format(fee - 0.01).replace('.', ',')
@@ -161,36 +729,459 @@ def apply_conditional_formatting(sheet_name, sheet_id, column_letter, row_count,
         ]
     }
 
-    try:
-        sheets_api.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=conditional_formatting_request).execute()
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+    for request in conditional_formatting_request["requests"]:
+        report.write_buffer.add_request(request)
 
 def get_sheet_id(sheet_name):
-    sheet_metadata = sheets_api.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    sheets = sheet_metadata.get('sheets', '')
-    sheet_id = None
-    for sheet in sheets:
-        if sheet['properties']['title'] == sheet_name:
-            sheet_id = sheet['properties']['sheetId']
-            break
+    sheet_id = get_tabs().get(sheet_name)
+    if sheet_id is not None and sheet_id < 0:
+        # Tab still waiting in the write buffer
+        report.write_buffer.flush()
+        sheet_id = report.tabs.get(sheet_name)
     return sheet_id
 
-    
-def create_and_copy_rows_to_tabs(fee, first_provider):
-    data = citas
-    data[0].append("id-vlookup1")
-    data[0].append("id-boleta")
-    data[0].append("largo-rut")
-    data[0].append("folio")
-    data[0].append("monto-boleta")
-    data[0].append("monto-servicios")
-    data[0].append("valor")
-    data[0].append("voucher pos")
-    data[0].append("propina pos")
-    data[0].append("participantes venta")
-    unique_values = sorted(list(set(row[4] for row in data[1:])))
-    
+
+# Sheets compares lookup keys as text, ignoring case
+def lookup_key(value):
+    return '' if value is None else str(value).lower()
+
+def to_number(value):
+    if value is None or value == '' or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def cell_text(value):
+    return '' if value is None else str(value)
+
+def hyperlink(url, label):
+    url = cell_text(url).replace('"', '""')
+    label = cell_text(label).replace('"', '""')
+    return f'=HYPERLINK("{url}";"{label}")'
+
+HYPERLINK_FORMULA = re.compile(r'^=HYPERLINK\("((?:[^"]|"")*)";"((?:[^"]|"")*)"\)$')
+
+def parse_hyperlink(value):
+    match = HYPERLINK_FORMULA.match(value) if isinstance(value, str) else None
+    return (match.group(1).replace('""', '"'), match.group(2).replace('""', '"')) if match else None
+
+# Local outputs get what Sheets would show for a USER_ENTERED cell
+def local_value(value):
+    if isinstance(value, str) and value.startswith("'"):
+        return value[1:]
+    return value
+
+def local_text(value):
+    link = parse_hyperlink(value)
+    return link[1] if link else normalize_cell(value)
+
+# Cells as the sheet holds them after a USER_ENTERED write, numbers kept as
+# numbers: quoted text without its quote, database numerics as int or float
+def typed_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, numbers.Number):
+        number = float(value)
+        return int(number) if number.is_integer() else number
+    if isinstance(value, str):
+        return value[1:] if value.startswith("'") else value
+    return normalize_cell(value)
+
+# Rows as an unformatted values read returns them, without trailing blanks
+def typed_rows(values):
+    rows = []
+    for row in values:
+        cells = [typed_cell(v) for v in row]
+        while cells and cells[-1] == '':
+            cells.pop()
+        rows.append(cells)
+    return rows
+
+# Text cells that are kept as datetime64 when every one of them prints back the
+# same. They are printed from the ISO text numpy gives, strftime is much slower.
+TIMESTAMP_FORMATS = {
+    '%Y-%m-%d %H:%M': lambda iso: f'{iso[:10]} {iso[11:]}',
+    '%Y%m%d %H:%M': lambda iso: f'{iso[:4]}{iso[5:7]}{iso[8:10]} {iso[11:]}',
+}
+# Rows rebuilt from the columns at a time
+DATASET_CHUNK_ROWS = 10000
+
+def timestamp_texts(values, timestamp_format):
+    to_text = TIMESTAMP_FORMATS[timestamp_format]
+    return ['' if iso == 'NaT' else to_text(iso) for iso in np.datetime_as_string(values.to_numpy(), unit='m').tolist()]
+
+def compact_column(values):
+    # Integers and decimals as nullable numbers, timestamps as datetime64 and
+    # everything else dictionary-encoded, keeping the exact Python values
+    present = [v for v in values if v != '']
+    kinds = {type(v) for v in present}
+    if kinds == {int} or kinds == {float}:
+        return pd.array([None if v == '' else v for v in values], dtype='Int64' if kinds == {int} else 'Float64'), None
+    if kinds == {str}:
+        text = pd.Series(values, dtype=object)
+        for timestamp_format in TIMESTAMP_FORMATS:
+            try:
+                datetime.datetime.strptime(present[0], timestamp_format)
+            except (IndexError, ValueError):
+                continue
+            parsed = pd.to_datetime(text, format=timestamp_format, errors='coerce')
+            if parsed.notna().sum() == len(present) and [v for v in timestamp_texts(parsed.array, timestamp_format) if v] == present:
+                return parsed.array, timestamp_format
+    codes, uniques = pd.factorize(np.array(values, dtype=object))
+    return pd.Categorical.from_codes(codes, categories=pd.Index(uniques, dtype=object)), None
+
+class Dataset:
+    # A tab held column by column instead of as lists of cells (see
+    # compact_column). It is never modified: rows are rebuilt on demand as the
+    # same lists typed_rows gives, and every call returns new lists.
+
+    def __init__(self, values):
+        self.length = len(values)
+        self.header = list(values[0]) if values else []
+        rows = values[1:]
+        self.size = len(rows)
+        self.width = max((len(row) for row in rows), default=0)
+        self.columns = []
+        self.formats = []
+        # Values of the dictionary-encoded columns by code, '' for code -1
+        self.lookups = []
+        for i in range(self.width):
+            column, timestamp_format = compact_column([row[i] if i < len(row) else '' for row in rows])
+            self.columns.append(pd.Series(column, copy=False))
+            self.formats.append(timestamp_format)
+            self.lookups.append(np.append(column.categories.to_numpy(dtype=object), '') if isinstance(column, pd.Categorical) else None)
+
+    def __len__(self):
+        return self.length
+
+    def cells(self, i, positions=None):
+        # Python values of column i, blanks as ''
+        if i >= self.width:
+            return [''] * (self.size if positions is None else len(positions))
+        column = self.columns[i].array
+        if self.lookups[i] is not None:
+            return self.lookups[i][column.codes if positions is None else column.codes[positions]].tolist()
+        if positions is not None:
+            column = column.take(positions)
+        if self.formats[i]:
+            return timestamp_texts(column, self.formats[i])
+        return column.to_numpy(dtype=object, na_value='').tolist()
+
+    def text(self, i):
+        # cell_text of column i, as a Series
+        if i < self.width and self.lookups[i] is not None:
+            text = np.array([cell_text(v) for v in self.lookups[i]], dtype=object)
+            return pd.Series(text[self.columns[i].array.codes], dtype=object)
+        return pd.Series([cell_text(v) for v in self.cells(i)], dtype=object)
+
+    def keys(self, i):
+        return self.text(i).map(str.lower)
+
+    def blank_rows(self):
+        blank = np.ones(self.size, dtype=bool)
+        for i in range(self.width):
+            # Typed cells are only blank when missing
+            blank &= (self.text(i) == '').to_numpy() if self.lookups[i] is not None else self.columns[i].isna().to_numpy()
+        return blank
+
+    def rows_at(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        for start in range(0, len(positions), DATASET_CHUNK_ROWS):
+            chunk = positions[start:start + DATASET_CHUNK_ROWS]
+            for cells in zip(*[self.cells(i, chunk) for i in range(self.width)]) if self.width else ([] for _ in chunk):
+                row = list(cells)
+                while row and row[-1] == '':
+                    row.pop()
+                yield row
+
+    def rows(self, start=0, stop=None):
+        return self.rows_at(np.arange(start, self.size if stop is None else min(stop, self.size)))
+
+    def groups(self, i):
+        # Value of column i -> positions of its rows, in row order
+        codes, uniques = pd.factorize(np.array(self.cells(i), dtype=object))
+        order = np.argsort(codes, kind='stable')
+        bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1]
+        return dict(zip(uniques.tolist(), np.split(order, bounds)))
+
+    def sort_positions(self, columns):
+        # Positions ordered by the text of the columns, descending and stable like sorted(reverse=True)
+        ranks = [pd.factorize(self.text(i).to_numpy(), sort=True)[0] for i in columns]
+        return np.lexsort([-rank for rank in reversed(ranks)]) if ranks else np.arange(self.size)
+
+    def digest(self):
+        digest = hashlib.blake2b(json.dumps([self.header, self.size, self.formats], default=str).encode(), digest_size=16)
+        for column in self.columns:
+            digest.update(str(column.dtype).encode())
+            digest.update(pd.util.hash_pandas_object(column, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+
+class RowIndex:
+    # First non-blank row for every lookup key of a column, like VLOOKUP(...;FALSE),
+    # looked up in batches
+
+    def __init__(self, dataset, column):
+        self.dataset = dataset
+        keys = dataset.keys(column)[~dataset.blank_rows()]
+        keys = keys[~keys.duplicated()]
+        self.index = pd.Index(keys.to_numpy(), dtype=object)
+        self.positions = keys.index.to_numpy()
+
+    def rows(self, keys):
+        keys = list(keys)
+        found = self.index.get_indexer(keys) if len(self.index) else np.full(len(keys), -1)
+        fetched = self.dataset.rows_at(self.positions[found[found >= 0]])
+        return [next(fetched) if position >= 0 else None for position in found]
+
+def array_formula_row(header, formulas):
+    # Header row for --array-formulas: each computed column is one formula in
+    # its header cell that spills over the rows below, ={"header"; formula}
+    return [f'={{"{name}"; {formula}}}' if formula else name for name, formula in zip(header, formulas)]
+
+def column_letter(index):
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+def dataset_frame(tab_name, width):
+    # Columns are named after the sheet letters so the code reads like the formulas
+    dataset = get_dataset(tab_name)
+    columns = [column_letter(i) for i in range(width)]
+    return pd.DataFrame({column: dataset.cells(i) for i, column in enumerate(columns)}, columns=columns).fillna('')
+
+def frame_values(frame):
+    return frame.astype(object).values.tolist()
+
+@traced
+def build_provider_indexes():
+    # First match wins, like VLOOKUP(...;FALSE). The big tabs are looked up in
+    # batches per provider instead of holding a dict of their rows.
+    dtes, errores, emisores, transacciones = get_datasets(['DTEs', 'Errores', 'Emisores', 'Transacciones'])
+    indexes = {
+        'dtes': RowIndex(dtes, 0),
+        'errores': RowIndex(errores, 0),
+        'transacciones': RowIndex(transacciones, 0),
+        'emisores': {},
+        'providers': {},
+    }
+    # The formula only looks at Emisores!$A$1:$B$100
+    for row in itertools.chain([emisores.header] if len(emisores) else [], emisores.rows(0, 99)):
+        if row:
+            indexes['emisores'].setdefault(lookup_key(row[0]), row)
+    citas = pd.DataFrame({'key': report.citas.keys(0), 'provider': report.citas.text(4)})
+    citas = citas[citas['provider'] != ''].drop_duplicates()
+    for key, provider in zip(citas['key'].tolist(), citas['provider'].tolist()):
+        indexes['providers'].setdefault(key, set()).add(provider)
+    return indexes
+
+def provider_lookups(rows, indexes):
+    # What every row of a provider tab finds in the other tabs: the Emisores,
+    # DTEs, Errores and Transacciones rows and the providers of its payment
+    keys = []
+    for row in rows:
+        payment_id = cell_text(row[0])
+        provider = cell_text(row[4]) if len(row) > 4 else ''
+        emisor = indexes['emisores'].get(lookup_key(provider))
+        id_vlookup = f"{payment_id}-{cell_text(emisor[1])}" if emisor is not None and len(emisor) > 1 else ''
+        keys.append((emisor, lookup_key(id_vlookup), lookup_key(f"{payment_id}-{provider}"), lookup_key(payment_id)))
+    dtes = indexes['dtes'].rows(key[1] for key in keys)
+    errores = indexes['errores'].rows(key[2] for key in keys)
+    transacciones = indexes['transacciones'].rows(key[3] for key in keys)
+    return [
+        (key[0], dte, error, transaccion, indexes['providers'].get(key[3], set()))
+        for key, dte, error, transaccion in zip(keys, dtes, errores, transacciones)
+    ]
+
+def materialize_provider_rows(rows, indexes):
+    # Same values the function01..function10 formulas would compute for these rows
+    totals = {}
+    for row in rows:
+        price = to_number(row[6]) if len(row) > 6 else None
+        totals[lookup_key(row[0])] = totals.get(lookup_key(row[0]), 0) + (price or 0)
+
+    result = []
+    for row, (emisor, dte, error, transaccion, providers) in zip(rows, provider_lookups(rows, indexes)):
+        payment_id = cell_text(row[0])
+        out = [cell_text(v) if v is None else v for v in row] + [''] * (12 - len(row))
+
+        if payment_id == '':
+            values = ['', '', '', '', '', '', '']
+        else:
+            if emisor is None or len(emisor) < 2:
+                values = ['#N/A'] * 6 + ['']
+            else:
+                id_vlookup = f"{payment_id}-{cell_text(emisor[1])}"
+                if dte is not None:
+                    dte = list(dte) + [''] * (12 - len(dte))
+                    folio = cell_text(dte[10])
+                    if folio.startswith("'"):
+                        folio = folio[1:]
+                    id_boleta = hyperlink(dte[11], folio)
+                    largo_rut = len(cell_text(dte[5])) - 2
+                    label = folio
+                    monto_boleta = dte[9]
+                else:
+                    if error is not None:
+                        label = cell_text(error[5]) if len(error) > 5 else ''
+                    else:
+                        label = 'Sin DTE'
+                    id_boleta = label
+                    largo_rut = '#N/A'
+                    monto_boleta = '#N/A'
+                folio_number = to_number(label[:5]) if label != '' else 0
+                folio_number = '#VALUE!' if folio_number is None else int(math.floor(folio_number))
+                monto_servicios = math.ceil(totals[lookup_key(payment_id)])
+                monto = to_number(monto_boleta)
+                valor = monto / monto_servicios if monto is not None and monto_servicios else ''
+                values = [id_vlookup, id_boleta, largo_rut, folio_number, monto_boleta, monto_servicios, valor]
+
+        if transaccion is not None:
+            transaccion = list(transaccion) + [''] * (6 - len(transaccion))
+            values += [cell_text(transaccion[2]), cell_text(transaccion[4])]
+        else:
+            values += ['', '']
+        values.append(len(providers))
+        result.append(out + values)
+    return result
+
+# Provider tabs whose rows are built at the same time
+PROVIDER_WORKERS = 4
+provider_workers = PROVIDER_WORKERS
+
+def provider_tab_rows(header, rows, materialize, array_formulas, indexes):
+    # Rows of one provider tab, header first. Runs on the provider workers, so it
+    # only touches the rows it is given and the read-only indexes.
+    if materialize:
+        return [header] + materialize_provider_rows(rows, indexes)
+
+    if array_formulas:
+        # Same formulas over closed ranges; HYPERLINK and COUNTUNIQUEIFS do not
+        # spill under ARRAYFORMULA, so those columns go through MAP/LAMBDA
+        end = len(rows) + 1
+        return [array_formula_row(header, [None] * 12 + [
+            f'ARRAYFORMULA(IF(A2:A{end}<>""; A2:A{end}&"-"&VLOOKUP(E2:E{end};Emisores!$A$1:$B$100;2;FALSE);""))',
+            f'MAP(A2:A{end}; E2:E{end}; M2:M{end}; LAMBDA(a; e; m; IF(m<>""; IFERROR(HYPERLINK(VLOOKUP(m;DTEs!A:L;12;FALSE);VLOOKUP(m;DTEs!A:L;11;FALSE)); IFERROR(VLOOKUP(a&"-"&e;Errores!A:F;6;FALSE);"Sin DTE"));"")))',
+            f'ARRAYFORMULA(IF(M2:M{end}<>""; LEN(VLOOKUP(M2:M{end};DTEs!A:L;6;FALSE))-2;""))',
+            f'ARRAYFORMULA(IF(M2:M{end}<>""; INT(LEFT(RIGHT(N2:N{end};LEN(N2:N{end}));5));""))',
+            f'ARRAYFORMULA(IF(M2:M{end}<>""; VLOOKUP(M2:M{end};DTEs!A:L;10;FALSE);""))',
+            f'ARRAYFORMULA(IF(M2:M{end}<>""; CEILING(SUMIF(A:A;A2:A{end};G:G));""))',
+            f'ARRAYFORMULA(IFERROR(Q2:Q{end}/R2:R{end};""))',
+            f'ARRAYFORMULA(IFERROR(VLOOKUP(A2:A{end};Transacciones!A:F;3;FALSE);""))',
+            f'ARRAYFORMULA(IFERROR(VLOOKUP(A2:A{end};Transacciones!A:F;5;FALSE);""))',
+            f'MAP(A2:A{end}; LAMBDA(a; COUNTUNIQUEIFS(Citas!E:E;Citas!A:A;a)))',
+        ])] + [(row + [''] * 12)[:12] for row in rows]
+
+    function01 = "=IF(A@@<>\"\"; CONCAT(A@@;CONCAT(\"-\";VLOOKUP(E@@;Emisores!$A$1:$B$100;2;FALSE)));\"\")"
+    function02 = "=IF(M@@<>\"\"; IFERROR(HYPERLINK(VLOOKUP(M@@;DTEs!A:L;12;FALSE);VLOOKUP(M@@;DTEs!A:L;11;FALSE)); IFERROR(VLOOKUP(CONCAT(CONCAT(A@@;\"-\");E@@);Errores!A:F;6;FALSE);\"Sin DTE\"));\"\")"
+    function03 = "=IF(M@@<>\"\"; LEN(VLOOKUP(M@@;DTEs!A:L;6;FALSE))-2;\"\")"
+    function04 = "=IF(M@@<>\"\"; INT(LEFT(RIGHT(N@@;LEN(N@@));5));\"\")"
+    function05 = "=IF(M@@<>\"\"; VLOOKUP(M@@;DTEs!A:L;10;FALSE);\"\")"
+    function06 = "=IF(M@@<>\"\"; CEILING(SUMIFS(G:G;A:A;A@@));\"\")"
+    function07 = "=IFERROR(Q@@/R@@;\"\")"
+    function08 = "=IFERROR(VLOOKUP(A@@;Transacciones!A:F;3;false);\"\")"
+    function09 = "=IFERROR(VLOOKUP(A@@;Transacciones!A:F;5;false);\"\")"
+    function10 = "=COUNTUNIQUEIFS(Citas!E:E;Citas!A:A;A@@)"
+    ri = 2
+    function1_column = 'M'
+
+    for row in rows:
+        # fill empty cells
+        while len(row) < (ord(function1_column) - ord('A')):
+            row.append('')
+        # append functions
+        row.append(function01.replace("@@", str(ri)))
+        row.append(function02.replace("@@", str(ri)))
+        row.append(function03.replace("@@", str(ri)))
+        row.append(function04.replace("@@", str(ri)))
+        row.append(function05.replace("@@", str(ri)))
+        row.append(function06.replace("@@", str(ri)))
+        row.append(function07.replace("@@", str(ri)))
+        row.append(function08.replace("@@", str(ri)))
+        row.append(function09.replace("@@", str(ri)))
+        row.append(function10.replace("@@", str(ri)))
+        ri = ri + 1
+    return [header] + rows
+
+def provider_inputs(rows, indexes):
+    # The rows of the other tabs a provider tab looks up, first matches like its VLOOKUPs
+    return [[emisor, dte, error, transaccion, sorted(providers)]
+            for emisor, dte, error, transaccion, providers in provider_lookups(rows, indexes)]
+
+class ProviderProgress:
+    # Providers whose tab already made it to the spreadsheet, kept in the state
+    # dir so an interrupted run starts again with the first missing provider. A
+    # provider only counts once the write buffer has sent its rows, and the
+    # record is dropped when the data or the options of the run change.
+
+    def __init__(self, key):
+        self.path = os.path.join(STATE_DIR, report.spreadsheet_id, 'providers.json')
+        self.key = key
+        self.done = set()
+        self.pending = []
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored.get('key') == key:
+                self.done = set(stored.get('done', []))
+        except (OSError, ValueError):
+            pass
+
+    def written(self, provider):
+        self.pending.append(provider)
+
+    def flushed(self):
+        if not self.pending:
+            return
+        self.done.update(self.pending)
+        self.pending = []
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'key': self.key, 'done': sorted(self.done)}, f)
+
+    def finish(self):
+        report.write_buffer.flush()
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+@traced
+def create_and_copy_rows_to_tabs(fee, first_provider, materialize=False, array_formulas=False):
+    data = report.citas
+    header = data.header + [
+        "id-vlookup1",
+        "id-boleta",
+        "largo-rut",
+        "folio",
+        "monto-boleta",
+        "monto-servicios",
+        "valor",
+        "voucher pos",
+        "propina pos",
+        "participantes venta",
+    ]
+    # Row positions of every provider, grouped in one pass over the column
+    providers = data.groups(4)
+    unique_values = sorted(providers)
+    indexes = build_provider_indexes() if materialize or report.journal is not None else None
+
+    def provider_rows(value):
+        return list(data.rows_at(providers[value]))
+
+    progress = None
+    if not report.sink.local:
+        key = inputs_hash(fee, materialize, array_formulas, data.digest())
+        progress = ProviderProgress(key)
+        report.write_buffer.on_flush.append(progress.flushed)
+        if progress.done:
+            print(f"retomando: {len(progress.done)} prestadores ya escritos en una ejecución anterior")
+
+    todo = []
     process_all = (first_provider is None)
     for value in unique_values:
         if not value:
@@ -200,227 +1191,878 @@ def create_and_copy_rows_to_tabs(fee, first_provider):
             if not process_all:
                 print(f"skipping {value}")
                 continue
+        if progress and value in progress.done:
+            continue
+        if report.journal is not None:
+            rows = provider_rows(value)
+            if tab_unchanged(value, fee, materialize, array_formulas, header, rows, provider_inputs(rows, indexes)):
+                continue
+        todo.append(value)
+
+    def write_provider(value, rows):
         print(f"trabajando en '{value}'")
-        sheet_id = create_tab(value)
+        create_tab(value)
+        report.sink.format_percentage(value, 'S', 1, len(rows))
+        write_tab(value, rows)
+        report.sink.conditional_format(value, 'S', len(rows), fee)  # Apply conditional formatting to column 'S'
+        if progress:
+            progress.written(value)
 
-        # Copy rows with the corresponding value in column B to the new tab
-        filtered_rows = [data[0]] + [row for row in data[1:] if row[4] == value]
-        if not filtered_rows:
-            continue
+    # Workers build the rows of the next providers while this thread sends the
+    # finished ones through the sink in order. At most provider_workers tabs
+    # wait in memory besides the ones being built.
+    with ThreadPoolExecutor(max_workers=provider_workers) as executor:
+        building = collections.deque()
+        for value in todo:
+            building.append((value, executor.submit(lambda value: provider_tab_rows(header, provider_rows(value), materialize, array_formulas, indexes), value)))
+            if len(building) > provider_workers:
+                value, future = building.popleft()
+                write_provider(value, future.result())
+        while building:
+            value, future = building.popleft()
+            write_provider(value, future.result())
 
-        function01 = "=IF(A@@<>\"\"; CONCAT(A@@;CONCAT(\"-\";VLOOKUP(E@@;Emisores!$A$1:$B$100;2;FALSE)));\"\")"
-        function02 = "=IF(M@@<>\"\"; IFERROR(HYPERLINK(VLOOKUP(M@@;DTEs!A:L;12;FALSE);VLOOKUP(M@@;DTEs!A:L;11;FALSE)); IFERROR(VLOOKUP(CONCAT(CONCAT(A@@;\"-\");E@@);Errores!A:F;6;FALSE);\"Sin DTE\"));\"\")"
-        function03 = "=IF(M@@<>\"\"; LEN(VLOOKUP(M@@;DTEs!A:L;6;FALSE))-2;\"\")"
-        function04 = "=IF(M@@<>\"\"; INT(LEFT(RIGHT(N@@;LEN(N@@));5));\"\")"
-        function05 = "=IF(M@@<>\"\"; VLOOKUP(M@@;DTEs!A:L;10;FALSE);\"\")"
-        function06 = "=IF(M@@<>\"\"; CEILING(SUMIFS(G:G;A:A;A@@));\"\")"
-        function07 = "=IFERROR(Q@@/R@@;\"\")"
-        function08 = "=IFERROR(VLOOKUP(A@@;Transacciones!A:F;3;false);\"\")"
-        function09 = "=IFERROR(VLOOKUP(A@@;Transacciones!A:F;5;false);\"\")"
-        function10 = "=COUNTUNIQUEIFS(Citas!E:E;Citas!A:A;A@@)"
-        ri = 2
-        function1_column = 'M'
-
-        for row in filtered_rows[1:]:
-            # fill empty cells
-            while len(row) < (ord(function1_column) - ord('A')):
-                row.append('')
-            # append functions
-            row.append(function01.replace("@@", str(ri)))
-            row.append(function02.replace("@@", str(ri)))
-            row.append(function03.replace("@@", str(ri)))
-            row.append(function04.replace("@@", str(ri)))
-            row.append(function05.replace("@@", str(ri)))
-            row.append(function06.replace("@@", str(ri)))
-            row.append(function07.replace("@@", str(ri)))
-            row.append(function08.replace("@@", str(ri)))
-            row.append(function09.replace("@@", str(ri)))
-            row.append(function10.replace("@@", str(ri)))
-            ri = ri + 1
-
-        # Update the range_name to cover the entire range being written
-        last_column = chr(ord('A') + max(len(row) for row in filtered_rows) - 1)
-        range_name = f'{value}!A1:{last_column}{len(filtered_rows)}'
-        body = {
-            'values': filtered_rows
-        }
-        try:
-            sheets_api.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range=range_name, valueInputOption="USER_ENTERED", body=body).execute()
-            format_percentage_column(value, sheet_id, 'S', 1, len(filtered_rows))
-            apply_conditional_formatting(value, sheet_id, 'S', len(filtered_rows), fee)  # Apply conditional formatting to column 'S'
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-    
+    if progress:
+        progress.finish()
+        report.write_buffer.on_flush.remove(progress.flushed)
+
+#not used
 def find_column_height(tab_name, column):
 
+        # Pending writes have to land before the column can be measured
+        report.write_buffer.flush()
+
         # Define the range in which you want to search for the last non-empty cell
         range_ = f'{tab_name}!{column}:{column}'
 
         # Get all values in column 'A'
-        response = sheets_api.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_).execute()
+        response = execute_read(get_sheets_api().spreadsheets().values().get(spreadsheetId=report.spreadsheet_id, range=range_))
         values = response.get('values', [])
         
         # Find the last non-empty cell in column 'A'
         return len(values)
 
-def create_tab(tab_name, freeze_headers=True):
-    if tab_name in tabs:
-        try:
-            range_all = f'{tab_name}!A1:Z'
-            sheets_api.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range=range_all, body={}).execute()
-        except HttpError as error:
-            print(f"Could not clean tab {tab_name}: {error}")
-        return tabs[tab_name]
-    
-    create_tab_request = {
-        "addSheet": {
-            "properties": {
-                "title": tab_name
+def create_sheet_tab(tab_name, freeze_headers=True):
+    if tab_name in get_tabs():
+        # In incremental mode write_tab only replaces the rows that changed
+        if not report.incremental:
+            get_row_hashes().touch(tab_name)
+            report.write_buffer.clear(f'{tab_name}!A1:Z')
+        return report.tabs[tab_name]
+
+    # sheet_id is a placeholder until the buffer is flushed
+    sheet_id = report.write_buffer.add_sheet(tab_name)
+    report.tabs[tab_name] = sheet_id
+    if freeze_headers:
+        freeze_request = {
+            'updateSheetProperties': {
+                'properties': {
+                    'sheetId': sheet_id,
+                    'gridProperties': {
+                        'frozenRowCount': 1
+                    }
+                },
+                'fields': 'gridProperties.frozenRowCount'
             }
         }
-    }
+        report.write_buffer.add_request(freeze_request)
+    return sheet_id
+
+# Incremental mode keeps a hash per written row so a re-run only sends the
+# rows that changed, the appended rows and a clear of the leftover rows
+STATE_DIR = '.r1_state'
+
+def normalize_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, numbers.Number):
+        number = float(value)
+        return str(int(number)) if number.is_integer() else repr(number)
+    value = str(value)
+    return value[1:] if value.startswith("'") else value
+
+def row_hash(row):
+    cells = [normalize_cell(v) for v in row]
+    while cells and cells[-1] == '':
+        cells.pop()
+    return hashlib.blake2b(json.dumps(cells).encode(), digest_size=8).hexdigest()
 
+class RowHashes:
+    # Hash of every row of the tabs as they are in the sheet, plus the width of
+    # the widest row, kept in the state dir in one file per tab. Like the
+    # journal, a tab drops its saved hashes before a flush sends anything to it
+    # and only gets them back once the whole tab has been sent, so a run that
+    # dies halfway leaves the tab to be hashed from the sheet again instead of
+    # trusting stale hashes. Runs without --incremental hash nothing, they only
+    # drop the saved hashes of the tabs they write.
+
+    def __init__(self, spreadsheet_id, incremental):
+        self.dir = os.path.join(STATE_DIR, spreadsheet_id, 'row_hashes')
+        self.incremental = incremental
+        self.previous = {}
+        self.written = {}
+        self.widths = {}
+        self.dirty = set()
+        self.dropped = set()
+        self.finished = set()
+
+    def path(self, tab_name):
+        return os.path.join(self.dir, hashlib.blake2b(tab_name.encode(), digest_size=8).hexdigest() + '.json')
+
+    def load(self, tab_name):
+        try:
+            with open(self.path(tab_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def before(self, tab_name):
+        # What the sheet held before this run started writing the tab
+        if tab_name not in self.previous:
+            saved = None if tab_name in self.dropped else self.load(tab_name)
+            if saved is not None:
+                self.previous[tab_name] = saved
+            else:
+                self.previous[tab_name] = {'hashes': [], 'width': 0}
+                if tab_name in report.tabs and report.tabs[tab_name] >= 0:
+                    report.write_buffer.flush()
+                    try:
+                        result = execute_read(get_sheets_api().spreadsheets().values().get(
+                            spreadsheetId=report.spreadsheet_id, range=tab_name,
+                            valueRenderOption='FORMULA', dateTimeRenderOption='FORMATTED_STRING'))
+                        values = result.get('values', [])
+                        self.previous[tab_name] = {'hashes': [row_hash(row) for row in values],
+                                                   'width': max((len(row) for row in values), default=0)}
+                    except HttpError as error:
+                        print(f"An error occurred: {error}")
+        return self.previous[tab_name]
+
+    def touch(self, tab_name):
+        self.dirty.add(tab_name)
+        self.finished.discard(tab_name)
+
+    def write(self, tab_name, hashes, row, width):
+        self.touch(tab_name)
+        written = self.written.setdefault(tab_name, [])
+        del written[row - 1:]
+        written.extend(hashes)
+        self.widths[tab_name] = max(self.widths.get(tab_name, 0), width)
+
+    def finish(self, tab_name, row_count):
+        self.touch(tab_name)
+        del self.written.setdefault(tab_name, [])[row_count:]
+        self.finished.add(tab_name)
+
+    def sending(self):
+        for tab_name in self.dirty - self.dropped:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(tab_name))
+            self.dropped.add(tab_name)
+
+    def flushed(self):
+        if not self.finished:
+            return
+        for tab_name in self.finished:
+            if self.incremental:
+                self.save(tab_name)
+                self.dropped.discard(tab_name)
+        self.dirty -= self.finished
+        self.finished = set()
+
+    def save(self, tab_name):
+        os.makedirs(self.dir, exist_ok=True)
+        with open(self.path(tab_name), 'w') as f:
+            json.dump({'hashes': self.written.get(tab_name, []), 'width': self.widths.get(tab_name, 0)}, f)
+
+def get_row_hashes():
+    if report.row_hashes is None:
+        report.row_hashes = RowHashes(report.spreadsheet_id, report.incremental)
+        report.write_buffer.before_flush.append(report.row_hashes.sending)
+        report.write_buffer.on_flush.append(report.row_hashes.flushed)
+    return report.row_hashes
+
+def write_sheet_rows(tab_name, rows, row=1):
+    row_hashes = get_row_hashes()
+    if not report.incremental:
+        row_hashes.touch(tab_name)
+        report.write_buffer.add_values(tab_name, rows, row=row)
+        return
+
+    # Changed rows are padded to the widest of the old and new rows, so cells
+    # left over from a longer old row are blanked
+    hashes = [row_hash(r) for r in rows]
+    width = max((len(r) for r in rows), default=0)
+    previous = row_hashes.before(tab_name)
+    row_hashes.write(tab_name, hashes, row, width)
+    old = previous['hashes']
+    width = max(width, previous['width'])
+    start = None
+    for i in range(len(rows) + 1):
+        changed = i < len(rows) and (row - 1 + i >= len(old) or old[row - 1 + i] != hashes[i])
+        if changed and start is None:
+            start = i
+        elif not changed and start is not None:
+            block = [list(r) + [''] * (width - len(r)) for r in rows[start:i]]
+            report.write_buffer.add_values(tab_name, block, row=row + start)
+            start = None
+
+def finish_sheet_tab(tab_name, row_count):
+    row_hashes = get_row_hashes()
+    if report.incremental:
+        old = row_hashes.before(tab_name)['hashes']
+        if len(old) > row_count:
+            report.write_buffer.clear(f'{tab_name}!A{row_count + 1}:Z{len(old)}')
+    row_hashes.finish(tab_name, row_count)
+
+class RunJournal:
+    # Hash of the inputs every tab was last written from. A tab whose inputs and
+    # parameters hash the same as in the journal is left as it is in the sheet.
+    # A new hash only counts once the whole tab has been sent, and the old one is
+    # dropped as soon as a tab starts being rewritten, so a run that dies halfway
+    # never leaves a half-written tab marked as up to date.
+
+    def __init__(self, spreadsheet_id):
+        self.path = os.path.join(STATE_DIR, spreadsheet_id, 'journal.json')
+        self.building = {}
+        self.pending = {}
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def unchanged(self, tab_name, key):
+        return self.entries.get(tab_name) == key and tab_name in get_tabs()
+
+    def start(self, tab_name, key):
+        self.building[tab_name] = key
+        self.forget(tab_name)
+
+    def forget(self, tab_name):
+        self.pending.pop(tab_name, None)
+        if self.entries.pop(tab_name, None) is not None:
+            self.save()
+
+    def written(self, tab_name):
+        if tab_name in self.building:
+            self.pending[tab_name] = self.building.pop(tab_name)
+
+    def flushed(self):
+        if not self.pending:
+            return
+        self.entries.update(self.pending)
+        self.pending = {}
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.entries, f)
+
+# Lists of rows are hashed this many rows at a time, so a big tab never
+# becomes one JSON string
+HASH_CHUNK_ROWS = 10000
+
+def inputs_hash(*inputs):
+    digest = hashlib.blake2b(digest_size=16)
+    for value in inputs:
+        if isinstance(value, list) and value and isinstance(value[0], (list, tuple)):
+            digest.update(f"rows {len(value)}".encode())
+            for i in range(0, len(value), HASH_CHUNK_ROWS):
+                digest.update(json.dumps(value[i:i + HASH_CHUNK_ROWS], default=str).encode())
+        else:
+            digest.update(json.dumps(value, default=str).encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def dataset_hash(tab_name):
+    # Computed once per report
+    if tab_name not in report.dataset_hashes:
+        if report.aggregates is not None and tab_name in report.aggregates:
+            report.dataset_hashes[tab_name] = inputs_hash(frame_values(report.aggregates[tab_name]))
+        else:
+            report.dataset_hashes[tab_name] = get_dataset(tab_name).digest()
+    return report.dataset_hashes[tab_name]
+
+def tab_unchanged(tab_name, *inputs):
+    if report.journal is None:
+        return False
+    key = inputs_hash(*inputs)
+    if report.journal.unchanged(tab_name, key):
+        print(f"'{tab_name}' sin cambios desde la ejecución anterior, se omite")
+        return True
+    report.journal.start(tab_name, key)
+    return False
+
+# Output sinks. Builders create tabs and write rows through report.sink, which
+# is the spreadsheet by default or a local XLSX workbook, Parquet or CSV files.
+# Local sinks write each tab top to bottom in a single pass, so they only get
+# computed values and every tab is written with sequential rows.
+class SheetsSink:
+    local = False
+
+    def __init__(self):
+        self.formats = {}
+
+    def create_tab(self, tab_name, freeze_headers=True):
+        return create_sheet_tab(tab_name, freeze_headers)
+
+    def write_rows(self, tab_name, rows, row=1):
+        write_sheet_rows(tab_name, rows, row)
+
+    def finish_tab(self, tab_name, row_count):
+        finish_sheet_tab(tab_name, row_count)
+        for column, decimal_places, format_rows in self.formats.pop(tab_name, []):
+            format_percentage_column(tab_name, report.tabs[tab_name], column, decimal_places, format_rows)
+
+    def format_percentage(self, tab_name, column, decimal_places, row_count):
+        # Queued once the rows are, so a flush in the middle of the tab never
+        # formats rows past the grid of a new tab
+        self.formats.setdefault(tab_name, []).append((column, decimal_places, row_count))
+
+    def conditional_format(self, tab_name, column, row_count, fee):
+        apply_conditional_formatting(tab_name, report.tabs[tab_name], column, row_count, fee)
+
+    def close(self):
+        report.write_buffer.flush()
+
+class LocalSink:
+    local = True
+
+    def __init__(self, path):
+        self.path = path
+        self.next_row = {}
+
+    def create_tab(self, tab_name, freeze_headers=True):
+        if tab_name in self.next_row:
+            raise Exception(f"La pestaña '{tab_name}' ya fue escrita")
+        self.next_row[tab_name] = 1
+        self.open_tab(tab_name, freeze_headers)
+
+    def write_rows(self, tab_name, rows, row=1):
+        if row != self.next_row[tab_name]:
+            raise Exception(f"La pestaña '{tab_name}' debe escribirse en orden (fila {row}, se esperaba {self.next_row[tab_name]})")
+        self.next_row[tab_name] += len(rows)
+        self.append_rows(tab_name, rows, row)
+
+    def finish_tab(self, tab_name, row_count):
+        pass
+
+    def format_percentage(self, tab_name, column, decimal_places, row_count):
+        pass
+
+    def conditional_format(self, tab_name, column, row_count, fee):
+        pass
+
+    def file_path(self, tab_name, extension):
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(self.path, re.sub(r'[\\/:*?"<>|\x00]', '_', tab_name) + extension)
+
+def raise_open_files_limit():
+    # Up to the hard limit. resource is not available on Windows.
     try:
-        x = sheets_api.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": [create_tab_request]}).execute()
-        sheet_id = x["replies"][0]["addSheet"]["properties"]["sheetId"]
-        tabs[tab_name] = sheet_id
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+        with contextlib.suppress(ValueError, OSError):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+class XlsxSink(LocalSink):
+    # One worksheet per tab. constant_memory flushes each row to disk as soon
+    # as the next one starts, so memory does not grow with the report. Each
+    # worksheet keeps its temp file open until the workbook is closed, so the
+    # number of tabs is bounded by the open files limit, which is raised to the
+    # hard limit; reports with more providers than that need csv or parquet.
+
+    def __init__(self, path):
+        super().__init__(path)
+        try:
+            import xlsxwriter
+        except ImportError:
+            raise Exception("Se requiere el paquete xlsxwriter para --output xlsx")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Numeric text becomes a number, like USER_ENTERED does in Sheets
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_numbers': True, 'strings_to_formulas': False})
+        raise_open_files_limit()
+        self.worksheets = {}
+        self.percent_columns = {}
+        self.formats = {}
+
+    def open_tab(self, tab_name, freeze_headers):
+        # Worksheet names are limited to 31 characters without []:*?/\
+        name = re.sub(r'[\[\]:*?/\\]', '_', tab_name)[:31]
+        taken = {worksheet.get_name().lower() for worksheet in self.worksheets.values()}
+        suffix = 1
+        while name.lower() in taken:
+            suffix += 1
+            name = f"{name[:31 - len(str(suffix)) - 1]}~{suffix}"
+        try:
+            worksheet = self.workbook.add_worksheet(name)
+        except OSError as error:
+            if error.errno != errno.EMFILE:
+                raise
+            raise Exception(f"No caben más de {len(self.worksheets)} pestañas en --output xlsx con el límite de archivos abiertos "
+                            "(ulimit -n), use --output csv o parquet") from error
         if freeze_headers:
-            freeze_request = {
-                'updateSheetProperties': {
-                    'properties': {
-                        'sheetId': sheet_id,
-                        'gridProperties': {
-                            'frozenRowCount': 1
-                        }
-                    },
-                    'fields': 'gridProperties.frozenRowCount'
-                }
-            }
-            sheets_api.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": [freeze_request]}).execute()
-        return sheet_id
-    except HttpError as error:
-        print(f"Could not create tab {tab_name}: {error}")
-    return None
-        
+            worksheet.freeze_panes(1, 0)
+        self.worksheets[tab_name] = worksheet
+        self.percent_columns[tab_name] = {}
+
+    def cell_format(self, properties):
+        key = json.dumps(properties, sort_keys=True)
+        if key not in self.formats:
+            self.formats[key] = self.workbook.add_format(properties)
+        return self.formats[key]
+
+    def format_percentage(self, tab_name, column, decimal_places, row_count):
+        # Called before the rows are written, cells carry their own format
+        pattern = f'0.{"".join(["0" for _ in range(decimal_places)])}%'
+        self.percent_columns[tab_name][ord(column) - ord('A')] = self.cell_format({'num_format': pattern})
+
+    def conditional_format(self, tab_name, column, row_count, fee):
+        if row_count < 2:
+            return
+        cells = f"{column}2:{column}{row_count}"
+        fee_from = "{:.2f}".format(fee - 0.01)
+        fee_to = "{:.2f}".format(fee + 0.01)
+        worksheet = self.worksheets[tab_name]
+        worksheet.conditional_format(cells, {
+            'type': 'formula', 'criteria': f"=AND({column}2>={fee_from},{column}2<={fee_to})",
+            'format': self.cell_format({'bg_color': '#00FF00'})})
+        worksheet.conditional_format(cells, {
+            'type': 'formula', 'criteria': f"=OR({column}2<{fee_from},{column}2>{fee_to})",
+            'format': self.cell_format({'bg_color': '#FFFF00'})})
+
+    def append_rows(self, tab_name, rows, row):
+        worksheet = self.worksheets[tab_name]
+        percent_columns = self.percent_columns[tab_name]
+        for i, values in enumerate(rows):
+            row_index = row - 1 + i
+            for column, value in enumerate(values):
+                cell_format = percent_columns.get(column) if row_index else None
+                link = parse_hyperlink(value)
+                if link:
+                    worksheet.write_url(row_index, column, link[0], cell_format, link[1])
+                elif value is not None and value != '':
+                    worksheet.write(row_index, column, local_value(value), cell_format)
+
+    def close(self):
+        self.workbook.close()
+        print(f"Reporte escrito en '{self.path}'")
+
+class CsvSink(LocalSink):
+    # One UTF-8 CSV per tab, with the text Sheets would display
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.files = {}
+
+    def open_tab(self, tab_name, freeze_headers):
+        f = open(self.file_path(tab_name, '.csv'), 'w', newline='', encoding='utf-8')
+        self.files[tab_name] = (f, csv.writer(f))
+
+    def append_rows(self, tab_name, rows, row):
+        self.files[tab_name][1].writerows([local_text(v) for v in values] for values in rows)
+
+    def finish_tab(self, tab_name, row_count):
+        # Tabs are written in one pass, so each file is closed as soon as its
+        # tab is done instead of keeping one open per provider
+        self.files.pop(tab_name)[0].close()
+
+    def close(self):
+        for f, writer in self.files.values():
+            f.close()
+        self.files.clear()
+        print(f"Reporte escrito en '{self.path}'")
+
+class ParquetSink(LocalSink):
+    # One Parquet file per tab. Columns are text because tabs like Catalogo mix
+    # numbers and labels in the same column; rows go out in row groups.
+    ROW_GROUP_ROWS = 50000
+
+    def __init__(self, path):
+        super().__init__(path)
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("Se requiere el paquete pyarrow para --output parquet")
+        self.writers = {}
+        self.pending = {}
+
+    def open_tab(self, tab_name, freeze_headers):
+        self.pending[tab_name] = []
+
+    def append_rows(self, tab_name, rows, row):
+        if row == 1 and rows:
+            self.open_writer(tab_name, rows[0])
+            rows = rows[1:]
+        self.pending[tab_name].extend(rows)
+        if len(self.pending[tab_name]) >= self.ROW_GROUP_ROWS:
+            self.write_pending(tab_name)
+
+    def open_writer(self, tab_name, header):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        names = []
+        for i, name in enumerate(header):
+            name = local_text(name) or column_letter(i)
+            names.append(name if name not in names else f"{name}_{column_letter(i)}")
+        schema = pa.schema([(name, pa.string()) for name in names])
+        self.writers[tab_name] = pq.ParquetWriter(self.file_path(tab_name, '.parquet'), schema)
+
+    def write_pending(self, tab_name):
+        import pyarrow as pa
+        writer = self.writers[tab_name]
+        width = len(writer.schema)
+        rows = [(list(values) + [None] * width)[:width] for values in self.pending[tab_name]]
+        columns = [pa.array([None if row[i] is None else local_text(row[i]) for row in rows], pa.string()) for i in range(width)]
+        writer.write_table(pa.Table.from_arrays(columns, schema=writer.schema))
+        self.pending[tab_name] = []
+
+    def finish_tab(self, tab_name, row_count):
+        self.close_tab(tab_name)
+
+    def close_tab(self, tab_name):
+        if tab_name in self.writers:
+            if self.pending[tab_name]:
+                self.write_pending(tab_name)
+            self.writers.pop(tab_name).close()
+        self.pending.pop(tab_name, None)
+
+    def close(self):
+        for tab_name in list(self.pending):
+            self.close_tab(tab_name)
+        print(f"Reporte escrito en '{self.path}'")
+
+OUTPUTS = {
+    'sheets': None,
+    'xlsx': XlsxSink,
+    'parquet': ParquetSink,
+    'csv': CsvSink,
+}
 
-def create_company_tabs(ruts):
+def make_sink(output, output_path=None):
+    if output == 'sheets':
+        return SheetsSink()
+    if output not in OUTPUTS:
+        raise Exception(f"Salida desconocida: {output}")
+    return OUTPUTS[output](output_path or ('reporte.xlsx' if output == 'xlsx' else 'reporte'))
+
+def create_tab(tab_name, freeze_headers=True):
+    return report.sink.create_tab(tab_name, freeze_headers)
+
+def write_rows(tab_name, rows, row=1):
+    report.sink.write_rows(tab_name, rows, row)
+
+def finish_tab(tab_name, row_count):
+    report.sink.finish_tab(tab_name, row_count)
+    if report.journal is not None:
+        report.journal.written(tab_name)
+
+def write_tab(tab_name, values):
+    write_rows(tab_name, values)
+    finish_tab(tab_name, len(values))
+
+
+def error_index():
+    # VLOOKUP(...;Errores!A:F;6) without FALSE does an approximate match over the sorted keys
+    errores_df = dataset_frame('Errores', 6)
+    errores_df = errores_df.assign(key=errores_df['A'].map(lookup_key)).sort_values('key', kind='stable')
+    return {
+        'error_keys': errores_df['key'].tolist(),
+        'errors': errores_df['F'].tolist(),
+    }
+
+@traced
+def build_company_index():
+    # Shared by every RUT/location so Citas and DTEs are grouped only once
+    if report.aggregates is not None:
+        return build_company_index_from_aggregates()
+    get_datasets(['Citas', 'DTEs', 'Errores'])
+    citas_df = dataset_frame('Citas', 12)
+    citas_df = citas_df[citas_df['A'].map(cell_text) != '']
+    citas_df = citas_df.assign(key=citas_df['A'].map(lookup_key), location=citas_df['C'].map(lookup_key))
+    dtes_df = dataset_frame('DTEs', 12)
+    dtes_df = dtes_df.assign(key=dtes_df['A'].map(lookup_key))
+
+    firsts = citas_df.drop_duplicates(['location', 'key'])
+    return {
+        # UNIQUE(FILTER(Citas!A2:A; Citas!C2:C=location))
+        'payments': {location: group['A'].tolist() for location, group in firsts.groupby('location', sort=False)},
+        # SUMIF(Citas!A:A;A;Citas!F:F)
+        'totals': citas_df['F'].map(to_number).groupby(citas_df['key']).sum(),
+        # SUMIF(DTEs!$A:$A;C;DTEs!$J:$J) and VLOOKUP(C;DTEs!A:L;12;FALSE)
+        'montos': dtes_df['J'].map(to_number).groupby(dtes_df['key']).sum(),
+        'pdfs': dtes_df.drop_duplicates('key').set_index('key')['L'],
+        **error_index(),
+    }
+
+def build_company_index_from_aggregates():
+    # Same index from one row per payment and location and one per payment and issuer
+    citas_df = report.aggregates['Citas']
+    citas_df = citas_df.assign(key=citas_df['payment_id'].map(lookup_key), location_key=citas_df['location'].map(lookup_key))
+    dtes_df = report.aggregates['DTEs']
+    dtes_df = dtes_df.assign(key=(dtes_df['payment_id'].map(cell_text) + '-' + dtes_df['emisor_rut'].map(cell_text)).map(lookup_key))
+
+    firsts = citas_df.drop_duplicates(['location_key', 'key'])
+    return {
+        'payments': {location: group['payment_id'].tolist() for location, group in firsts.groupby('location_key', sort=False)},
+        'totals': citas_df['booking_id_total'].map(to_number).groupby(citas_df['key']).sum(),
+        'montos': dtes_df['monto'].map(to_number).groupby(dtes_df['key']).sum(),
+        'pdfs': dtes_df.drop_duplicates('key').set_index('key')['pdf'],
+        **error_index(),
+    }
+
+def sheet_number(value):
+    return int(value) if float(value).is_integer() else float(value)
+
+def compute_company_rows(index, rut, location):
+    rows = []
+    for payment_id in index['payments'].get(lookup_key(location), []):
+        key = lookup_key(payment_id)
+        id_vlookup = f"{cell_text(payment_id)}-{rut}"
+        if lookup_key(id_vlookup) in index['pdfs'].index:
+            dte = index['pdfs'][lookup_key(id_vlookup)]
+        else:
+            position = bisect.bisect_right(index['error_keys'], lookup_key(f"{cell_text(payment_id)}-{location}"))
+            dte = index['errors'][position - 1] if position else '#N/A'
+        rows.append([
+            payment_id,
+            sheet_number(index['totals'].get(key, 0)),
+            id_vlookup,
+            sheet_number(index['montos'].get(lookup_key(id_vlookup), 0)),
+            dte,
+        ])
+    return rows
+
+@traced
+def create_company_tabs(ruts, formulas=False, array_formulas=False):
+    index = build_company_index()
 
     for rut_and_location in ruts:
         if not rut_and_location:
             continue
         rut, location = rut_and_location.split("/")
         tab_name = f"{location}-{rut}"
+        if tab_unchanged(tab_name, rut, location, formulas, array_formulas, report.aggregates is not None,
+                         dataset_hash('Citas'), dataset_hash('DTEs'), dataset_hash('Errores')):
+            continue
         print(f"trabajando en '{rut}'")
 
         create_tab(tab_name)
-        
-        # Copy payment_ids from Citas
-        sheets_api.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f'{tab_name}!A1:A2',
-            valueInputOption='USER_ENTERED',
-            body={'values': [
-                ['id-payment'], 
-                [f'=UNIQUE(FILTER(Citas!A2:A; Citas!C2:C="{location}"))']
-            ]}
-        ).execute()
-
-        last_non_empty_cell = find_column_height(tab_name, 'A')
-
-        arr = [['total', 'id-vlookup', 'monto-boleta', 'dte']]
-        
+
+        arr = [['id-payment', 'total', 'id-vlookup', 'monto-boleta', 'dte']]
+        if not formulas:
+            arr.extend(compute_company_rows(index, rut, location))
+            write_tab(tab_name, arr)
+            continue
+
+        # Payment ids come from the shared index so the formulas need no read-back
+        payment_ids = index['payments'].get(lookup_key(location), [])
+        if array_formulas:
+            if payment_ids:
+                end = len(payment_ids) + 1
+                citas_end = len(get_dataset('Citas'))
+                arr = [array_formula_row(arr[0], [
+                    f'UNIQUE(FILTER(Citas!A2:A{citas_end}; Citas!C2:C{citas_end}="{location}"))',
+                    f'ARRAYFORMULA(SUMIF(Citas!A:A;A2:A{end};Citas!F:F))',
+                    f'ARRAYFORMULA(A2:A{end}&"-{rut}")',
+                    f'ARRAYFORMULA(SUMIF(DTEs!$A:$A;C2:C{end};DTEs!$J:$J))',
+                    f'ARRAYFORMULA(IFERROR(VLOOKUP(C2:C{end};DTEs!A:L;12;FALSE);VLOOKUP(A2:A{end}&"-{location}";Errores!A:F;6)))',
+                ])]
+            write_tab(tab_name, arr)
+            continue
         arr.extend([
             [
+                payment_ids[i],
                 f'=SUMIF(Citas!A:A;A{str(i+2)};Citas!F:F)',
                 f'=CONCAT($A{str(i+2)};"-{rut}")',
                 f'=SUMIF(DTEs!$A:$A;C{str(i+2)};DTEs!$J:$J)',
                 f'=IFERROR(VLOOKUP(C{str(i+2)};DTEs!A:L;12;FALSE);VLOOKUP(CONCAT(CONCAT(A{str(i+2)};"-");\"{location}\");Errores!A:F;6))',
-            ] for i in range(last_non_empty_cell-1)
+            ] for i in range(len(payment_ids))
         ])
 
-        sheets_api.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f'{tab_name}!B1:F' + str(last_non_empty_cell+1),
-            valueInputOption='USER_ENTERED',
-            body={'values': arr}
-        ).execute()
+        write_tab(tab_name, arr)
 
+# Catalogo rows are sent to the sink in chunks of this many rows
+CATALOGO_CHUNK_ROWS = 5000
 
-def create_catalogo_tabs():
+def catalogo_rows(citas, dtes):
+    # Merge-join of Citas and DTEs by payment_id and provider, descending, with the
+    # DTEs as an empty provider after the citas of the same key. Each side is put
+    # in order by sorting its key columns, and rows are rebuilt as they are merged.
+    def cell(row, i):
+        return row[i] if i < len(row) else ''
 
-    tab_name = "Catalogo"
-    print(f"trabajando en '{tab_name}'")
+    def side(dataset, columns, is_dte):
+        order = dataset.sort_positions(columns)
+        keys = zip(*[dataset.text(i).to_numpy()[order].tolist() for i in columns])
+        for key, row in zip(keys, dataset.rows_at(order)):
+            yield (key + ('',) if is_dte else key), row, is_dte
 
-    create_tab(tab_name)
-    dc = copy.deepcopy(citas[1:])
-    for row in dc:
-        row.extend(['', '', ''])
-    dc.extend([
-        [d[1], '', '', '', '', '', '0', '', '', '', '', '', '', d[6], d[5], d[9]]
-     for d in dtes[1:]])
-    dc = sorted(dc, key=lambda row: row[0] + '-' + row[4], reverse=True)
-    arr = [['payment_id', 'local', 'cliente', 'fecha', 'proveedor', 'servicio', 'subtotal_ítem', '', 'emisor', 'rut_emisor', 'subtotal_dte']]
+    merged = heapq.merge(side(citas, [0, 4], False), side(dtes, [1], True), key=lambda entry: entry[0], reverse=True)
 
     current_pid = None
     current_item_total = 0
-    for r in range(len(dc)):
-        if(dc[r][0] != current_pid):
-            current_pid = dc[r][0]
-            arr.extend([[dc[r][0], dc[r][2], dc[r][9]]])
+    for key, row, is_dte in merged:
+        payment_id = cell(row, 1) if is_dte else cell(row, 0)
+        if payment_id != current_pid:
+            if current_pid is not None:
+                yield ['', '', '', '', '', 'Total ítems', current_item_total]
+            current_pid = payment_id
+            yield [payment_id, '', ''] if is_dte else [payment_id, cell(row, 2), cell(row, 9)]
             current_item_total = 0
-        if(dc[r][6] != '0'):
-            arr.extend([['', '', '', dc[r][1], dc[r][4], dc[r][11], dc[r][6]]])
-            current_item_total += float(dc[r][6])
+        if is_dte:
+            yield ['', '', '', '', '', '', '', '', cell(row, 6), cell(row, 5), cell(row, 9)]
+        elif normalize_cell(cell(row, 6)) != '0':
+            yield ['', '', '', cell(row, 1), cell(row, 4), cell(row, 11), cell(row, 6)]
+            current_item_total += float(cell(row, 6))
         else:
-            arr.extend([['', '', '', '', '', '', '', '', dc[r][13], dc[r][14], dc[r][15]]])
-        if(r+1 == len(dc) or dc[r+1][0]!= current_pid):
-            arr.extend([['', '', '', '', '', 'Total ítems', current_item_total]])
-
-    sheets_api.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=f'{tab_name}!A1:K' + str(len(arr)),
-        valueInputOption='USER_ENTERED',
-        body={'values': arr}
-    ).execute()
-    
-def create_cruce_basico():
+            # A cita with no price shows up like a DTE row without a DTE
+            yield ['', '', '', '', '', '', '', '', '', '', '']
+    if current_pid is not None:
+        yield ['', '', '', '', '', 'Total ítems', current_item_total]
+
+@traced
+def create_catalogo_tabs():
+
+    tab_name = "Catalogo"
+    if tab_unchanged(tab_name, dataset_hash('Citas'), dataset_hash('DTEs')):
+        return
+    print(f"trabajando en '{tab_name}'")
+
+    create_tab(tab_name)
+    rows = itertools.chain(
+        [['payment_id', 'local', 'cliente', 'fecha', 'proveedor', 'servicio', 'subtotal_ítem', '', 'emisor', 'rut_emisor', 'subtotal_dte']],
+        catalogo_rows(report.citas, report.dtes))
+    written = 0
+    while True:
+        chunk = list(itertools.islice(rows, CATALOGO_CHUNK_ROWS))
+        if not chunk:
+            break
+        write_rows(tab_name, chunk, row=written + 1)
+        written += len(chunk)
+    finish_tab(tab_name, written)
+
+@traced
+def compute_cruce():
+    if report.aggregates is not None:
+        return compute_cruce_from_aggregates()
+    get_datasets(['Citas', 'DTEs', 'Errores'])
+    citas_df = dataset_frame('Citas', 12)
+    dtes_df = dataset_frame('DTEs', 12)
+
+    # UNIQUE(Citas!A2:A)
+    citas_df = citas_df[citas_df['A'].map(cell_text) != '']
+    citas_df = citas_df.assign(key=citas_df['A'].map(lookup_key))
+    cruce = citas_df.drop_duplicates('key')[['key', 'A', 'C']].reset_index(drop=True)
+    cruce.columns = ['key', 'payment_id', 'location']
+
+    # COUNTUNIQUEIFS(Citas!D:D;Citas!A:A;A)
+    providers = citas_df[citas_df['D'].map(cell_text) != ''].groupby('key')['D'].nunique()
+    cruce['provider-count'] = cruce['key'].map(providers).fillna(0).astype(int)
+
+    # COUNTIFS(DTEs!B:B;A;DTEs!E:E;tipo)
+    dtes_df = dtes_df.assign(key=dtes_df['B'].map(lookup_key), tipo=dtes_df['E'].map(lookup_key))
+    counts = dtes_df.groupby(['key', 'tipo']).size()
+    for column, tipo in (('BHE count', 'boleta_honorarios'), ('BA count', 'boleta')):
+        by_payment = counts.xs(tipo, level='tipo') if tipo in counts.index.get_level_values('tipo') else pd.Series(dtype=int)
+        cruce[column] = cruce['key'].map(by_payment).fillna(0).astype(int)
+
+    return finish_cruce(cruce)
+
+def compute_cruce_from_aggregates():
+    citas_df = report.aggregates['Citas']
+    citas_df = citas_df.assign(key=citas_df['payment_id'].map(lookup_key))
+    # Rows come newest first, so the first row of a payment has the location UNIQUE(Citas!A2:A) would see
+    cruce = citas_df.drop_duplicates('key')[['key', 'payment_id', 'location']].reset_index(drop=True)
+
+    # A payment booked in several locations has one row per location, so the providers are merged
+    providers = citas_df.groupby('key')['provider_ids'].agg(
+        lambda groups: len({cell_text(p) for ids in groups for p in (ids or []) if cell_text(p) != ''}))
+    cruce['provider-count'] = cruce['key'].map(providers).fillna(0).astype(int)
+
+    dtes_df = report.aggregates['DTEs']
+    counts = dtes_df[['bhe_count', 'ba_count']].groupby(dtes_df['payment_id'].map(lookup_key)).sum()
+    cruce['BHE count'] = cruce['key'].map(counts['bhe_count']).fillna(0).astype(int)
+    cruce['BA count'] = cruce['key'].map(counts['ba_count']).fillna(0).astype(int)
+
+    return finish_cruce(cruce)
+
+def finish_cruce(cruce):
+    errores_df = dataset_frame('Errores', 6)
+
+    cruce['Falta BHE'] = cruce['provider-count'] > cruce['BHE count']
+    cruce['Falta BA'] = (cruce['provider-count'] > 0) & (cruce['BA count'] == 0)
+    cruce['Falta DTE'] = cruce['Falta BHE'] | cruce['Falta BA']
+
+    # VLOOKUP(A;Errores!B:F;...;false) takes the first error of the payment
+    errores_df = errores_df.assign(key=errores_df['B'].map(lookup_key)).drop_duplicates('key').set_index('key')
+    emisor = cruce['key'].map(errores_df['E'])
+    error = cruce['key'].map(errores_df['F'])
+    cruce['Emisor'] = emisor.where(cruce['Falta DTE'] & emisor.notna(), '')
+    cruce['Error'] = error.where(error.notna(), 'No hubo error').where(cruce['Falta DTE'], '')
+
+    return cruce.drop(columns='key')
+
+@traced
+def create_cruce_basico(formulas=False, array_formulas=False):
 
     tab_name = f"Cruce"
+    if tab_unchanged(tab_name, formulas, array_formulas, report.aggregates is not None,
+                     dataset_hash('Citas'), dataset_hash('DTEs'), dataset_hash('Errores')):
+        return
     print(f"trabajando en '{tab_name}'")
     create_tab(tab_name)
 
-    # Insert payment ids
-    sheets_api.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=f'{tab_name}!A1:A2',
-        valueInputOption='USER_ENTERED',
-        body={'values': [[
-            'payment_id'
-        ], ['=UNIQUE(Citas!A2:A)']]}
-    ).execute()
-
-    payment_id_count = find_column_height(tab_name, 'A') - 1
-
-    sheets_api.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=f'{tab_name}!B1:J1',
-        valueInputOption='USER_ENTERED',
-        body={'values': [[
-            'location', 
-            'provider-count',
-            'BHE count',
-            'BA count',
-            'Falta BHE',
-            'Falta BA',
-            'Falta DTE',
-            'Emisor',
-            'Error'
-        ]]}
-    ).execute()
+    header = [
+        'payment_id',
+        'location',
+        'provider-count',
+        'BHE count',
+        'BA count',
+        'Falta BHE',
+        'Falta BA',
+        'Falta DTE',
+        'Emisor',
+        'Error'
+    ]
+
+    cruce = compute_cruce()
+    if not formulas:
+        write_tab(tab_name, [header] + frame_values(cruce))
+        return
 
+    if array_formulas:
+        rows = [header]
+        if len(cruce):
+            end = len(cruce) + 1
+            citas_end = len(get_dataset('Citas'))
+            rows = [array_formula_row(header, [
+                f'UNIQUE(FILTER(Citas!A2:A{citas_end}; Citas!A2:A{citas_end}<>""))',
+                f'ARRAYFORMULA(VLOOKUP(A2:A{end};Citas!A:L;3;FALSE))',
+                f'MAP(A2:A{end}; LAMBDA(p; COUNTUNIQUEIFS(Citas!D:D;Citas!A:A;p)))',
+                f'ARRAYFORMULA(COUNTIFS(DTEs!B:B;A2:A{end};DTEs!E:E;"boleta_honorarios"))',
+                f'ARRAYFORMULA(COUNTIFS(DTEs!B:B;A2:A{end};DTEs!E:E;"boleta"))',
+                f'ARRAYFORMULA(C2:C{end}>D2:D{end})',
+                f'ARRAYFORMULA((C2:C{end}>0)*(E2:E{end}=0)=1)',
+                f'ARRAYFORMULA(F2:F{end}+G2:G{end}>0)',
+                f'ARRAYFORMULA(IF(H2:H{end}; IFERROR(VLOOKUP(A2:A{end};Errores!B:F;4;FALSE);"");""))',
+                f'ARRAYFORMULA(IF(H2:H{end}; IFERROR(VLOOKUP(A2:A{end};Errores!B:F;5;FALSE);"No hubo error");""))',
+            ])]
+        write_tab(tab_name, rows)
+        return
 
+    # Payment ids are computed locally so the formulas can be written without reading the tab back
+    payment_ids = frame_values(cruce[['payment_id']])
+    payment_id_count = len(payment_ids)
     values = [
-        [
+        payment_ids[i] + [
             f'=VLOOKUP(A{str(i+2)};Citas!A:L;3;FALSE)',
             f'=COUNTUNIQUEIFS(Citas!D:D;Citas!A:A;A{str(i+2)})',
             f'=COUNTIFs(DTEs!B:B;A{str(i+2)};DTEs!E:E;"boleta_honorarios")',
@@ -433,22 +2075,22 @@ def create_cruce_basico():
         ] for i in range(payment_id_count)
     ]
 
-    sheets_api.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=f'{tab_name}!B2:J' + str(payment_id_count+1),
-        valueInputOption='USER_ENTERED',
-        body={'values': values}
-    ).execute()
+    write_tab(tab_name, [header] + values)
+
+# Queries return (sql, params). Values are passed as parameters, never
+# interpolated, so the server can reuse plans. Queries on tready read the
+# payments already filtered into r1_payments by TreadySession.
+def query_params(company_id, date_from, date_to):
+    return {'company_id': company_id, 'date_from': date_from, 'date_to': date_to}
 
 def query_issuers(company_id, date_from, date_to):
-    return f"""
+    return """
     -- Búsqueda Emisores
     with real_ruts as (select p.company_id, d.issuer_identification as rut, d.issuer_name, count(1) as q
                    from dtes d
-                            left join payments p on d.payment_id = p.id
-                   where p.company_id = {company_id}
-                     and p.paid_at >= '{date_from}'
-                     and p.paid_at < '{date_to}'
+                            join r1_payments p on d.payment_id = p.id
+                   where p.paid_at >= %(date_from)s
+                     and p.paid_at < %(date_to)s
                      and status = 'completed'
                      and version = 'final'
                    group by 1, 2, 3
@@ -458,11 +2100,11 @@ def query_issuers(company_id, date_from, date_to):
                                      params ->> 'name'                     as issuer_name,
                                      0                                     as q
                               from company_values
-                              where company_id = {company_id}
+                              where company_id = %(company_id)s
                               union all
                               select company_id, params ->> 'rut' as rut, params ->> 'name' as issuer_name, 0 as q
                               from provider_values
-                              where company_id = {company_id}),
+                              where company_id = %(company_id)s),
      theoretical_ruts as (select *
                           from raw_theoretical_ruts
                           where rut is not null)
@@ -470,9 +2112,16 @@ select
         coalesce(r.issuer_name, t.issuer_name) as issuer_name, 
         rut
 from real_ruts r
-         full outer join theoretical_ruts t using (company_id, rut);"""
+         full outer join theoretical_ruts t using (company_id, rut);""", query_params(company_id, date_from, date_to)
+
+# Extra trailing column with the day each row belongs to, used to split results into cache partitions
+def cache_day_column(expression, by_day):
+    return f",\n        to_char({expression}, 'yyyyMMdd') as cache_day" if by_day else ""
+
+def sort_key_column(expression, by_day):
+    return f",\n        to_char({expression}, 'yyyyMMddHH24MISSUS') as sort_key" if by_day else ""
 
-def query_dtes(company_id, date_from, date_to):
+def query_dtes(company_id, date_from, date_to, by_day=False):
     return f"""
     -- Búsqueda DTEs
     select p.payment_id::text || '-' || d.issuer_identification as vlookup_id,
@@ -486,17 +2135,16 @@ def query_dtes(company_id, date_from, date_to):
         d.customer_name                                      as receptor_nombre,
         d.total::int                                         as monto,
         '''' || ((d.document::json) ->> 'number')::text      as folio,
-        (d.document::json) ->> 'url'                         as pdf
+        (d.document::json) ->> 'url'                         as pdf{cache_day_column('p.paid_at', by_day)}
     from dtes d
-            join payments p on (p.id = d.payment_id)
-    where p.company_id = {company_id}
-    and p.paid_at >= '{date_from}'
-    and p.paid_at < '{date_to}'
+            join r1_payments p on (p.id = d.payment_id)
+    where p.paid_at >= %(date_from)s
+    and p.paid_at < %(date_to)s
     and status = 'completed'
     and version = 'final'
-    order by p.payment_id desc; """
+    order by p.payment_id desc; """, query_params(company_id, date_from, date_to)
 
-def query_citas(company_id, date_from, date_to):
+def query_citas(company_id, date_from, date_to, by_day=False):
     return f"""
     -- Búsqueda Citas
     select payment_id,
@@ -510,15 +2158,15 @@ def query_citas(company_id, date_from, date_to):
         client_id,
         client_name,
         service_id,
-        service_name
+        service_name{sort_key_column('booking_start_time', by_day)}{cache_day_column('booking_start_time', by_day)}
     from dwh.augmented_bookings
-    where company_id = {company_id}
-    and booking_start_time >= '{date_from}'
-    and booking_start_time < '{date_to}'
+    where company_id = %(company_id)s
+    and booking_start_time >= %(date_from)s
+    and booking_start_time < %(date_to)s
     and payment_id is not null
-    order by booking_start_time desc;"""
+    order by booking_start_time desc, payment_id desc;""", query_params(company_id, date_from, date_to)
 
-def query_transacciones(company_id, date_from, date_to):
+def query_transacciones(company_id, date_from, date_to, by_day=False):
     return f"""
     select 
         s.payment_id, 
@@ -526,18 +2174,18 @@ def query_transacciones(company_id, date_from, date_to):
         t.external_reference, 
         t.amount::int, 
         t.tip::int,
-        to_char(p.payment_date, 'yyyy-MM-dd HH24:mi') as payment_date
+        to_char(p.payment_date, 'yyyy-MM-dd HH24:mi') as payment_date{sort_key_column('t.created_at', by_day)}{cache_day_column('t.paid_at', by_day)}
     from transactions t
     left join payment_requests pr on t.payment_request_id = pr.id
     left join sales s on pr.cart_id = s.cart_id
     left join payments p on s.payment_id = p.id
-    where t.company_id = {company_id}
-    and t.paid_at >= '{date_from}'
-    and t.paid_at < '{date_to}'
+    where t.company_id = %(company_id)s
+    and t.paid_at >= %(date_from)s
+    and t.paid_at < %(date_to)s
     and t.paymentable_id = 40
-    order by t.created_at desc;"""
+    order by t.created_at desc;""", query_params(company_id, date_from, date_to)
 
-def query_errores(company_id, date_from, date_to):
+def query_errores(company_id, date_from, date_to, by_day=False):
     return f"""
     -- errores
     with all_errors as (
@@ -548,12 +2196,11 @@ def query_errores(company_id, date_from, date_to):
         d.issuer_name,
         case when d.status || '-' || d.version = 'error-final' then d.error ->> 'description' else null end as error,
         to_char(d.updated_at, 'yyyyMMdd HH:mi') as updated_at,
-        row_number() over (partition by p.payment_id, d.issuer_name order by d.updated_at desc) as rn
+        row_number() over (partition by p.payment_id, d.issuer_name order by d.updated_at desc) as rn{cache_day_column('p.paid_at', by_day)}
     from dtes d
-            left join payments p on d.payment_id = p.id
-    where p.company_id = {company_id}
-    and p.paid_at >= '{date_from}'
-    and p.paid_at < '{date_to}'
+            join r1_payments p on d.payment_id = p.id
+    where p.paid_at >= %(date_from)s
+    and p.paid_at < %(date_to)s
     and d.error is not null
     order by 1, 4)
     select 
@@ -562,93 +2209,946 @@ def query_errores(company_id, date_from, date_to):
         updated_at,
         issuer_identification,
         issuer_name,
-        error
+        error{', cache_day' if by_day else ''}
     from all_errors
     where rn = 1
-    order by 1, 3;"""
+    order by 1 collate "C", 3 collate "C";""", query_params(company_id, date_from, date_to)
+
+def query_citas_aggregates(company_id, date_from, date_to):
+    return """
+    -- Agregados Citas
+    select payment_id,
+        location,
+        array_agg(distinct provider_id::text) filter (where provider_id is not null) as provider_ids,
+        sum(booking_id)                                                              as booking_id_total
+    from dwh.augmented_bookings
+    where company_id = %(company_id)s
+    and booking_start_time >= %(date_from)s
+    and booking_start_time < %(date_to)s
+    and payment_id is not null
+    group by payment_id, location
+    order by max(booking_start_time) desc, payment_id desc;""", query_params(company_id, date_from, date_to)
+
+def query_dtes_aggregates(company_id, date_from, date_to):
+    return """
+    -- Agregados DTEs
+    select p.payment_id,
+        d.issuer_identification                                                   as emisor_rut,
+        count(1) filter (where lower(d.tax_receipt_type) = 'boleta_honorarios')   as bhe_count,
+        count(1) filter (where lower(d.tax_receipt_type) = 'boleta')              as ba_count,
+        sum(d.total::int)                                                         as monto,
+        (array_agg((d.document::json) ->> 'url' order by d.id))[1]                as pdf
+    from dtes d
+            join r1_payments p on (p.id = d.payment_id)
+    where p.paid_at >= %(date_from)s
+    and p.paid_at < %(date_to)s
+    and status = 'completed'
+    and version = 'final'
+    group by p.payment_id, d.issuer_identification
+    order by p.payment_id desc; """, query_params(company_id, date_from, date_to)
+
+# High-water marks polled by --watch, one row per day of the report range. A
+# day whose row changes has new or updated rows in the tabs cached by that day.
+def query_payments_watermarks(company_id, date_from, date_to):
+    return """
+    -- Marcas pagos y DTEs
+    select to_char(p.paid_at, 'yyyyMMdd') as day,
+        count(distinct p.id)              as payments,
+        max(p.paid_at)                    as paid_at,
+        count(d.id)                       as dtes,
+        max(d.updated_at)                 as updated_at
+    from payments p
+            left join dtes d on d.payment_id = p.id
+    where p.company_id = %(company_id)s
+    and p.paid_at >= %(date_from)s
+    and p.paid_at < %(date_to)s
+    group by 1;""", query_params(company_id, date_from, date_to)
+
+def query_bookings_watermarks(company_id, date_from, date_to):
+    # augmented_bookings keeps no update time, so the mark carries a digest of
+    # the columns query_citas extracts
+    return """
+    -- Marcas citas
+    select to_char(booking_start_time, 'yyyyMMdd') as day,
+        count(1)                                  as bookings,
+        sum(booking_price)                        as booking_price,
+        md5(string_agg(concat_ws('|', booking_id, payment_id, booking_start_time, location, provider_id, provider_name,
+                                 booking_price, booking_status, client_id, client_name, service_id, service_name),
+                       ',' order by booking_id)) as digest
+    from dwh.augmented_bookings
+    where company_id = %(company_id)s
+    and booking_start_time >= %(date_from)s
+    and booking_start_time < %(date_to)s
+    and payment_id is not null
+    group by 1;""", query_params(company_id, date_from, date_to)
+
+def query_transactions_watermarks(company_id, date_from, date_to):
+    return """
+    -- Marcas transacciones
+    select to_char(t.paid_at, 'yyyyMMdd') as day,
+        count(1)                          as transactions,
+        max(t.paid_at)                    as paid_at
+    from transactions t
+    where t.company_id = %(company_id)s
+    and t.paid_at >= %(date_from)s
+    and t.paid_at < %(date_to)s
+    and t.paymentable_id = 40
+    group by 1;""", query_params(company_id, date_from, date_to)
+
+# Tab, db_credentials key and query of every extracted tab, in tab order
+EXTRACTIONS = [
+    ("DTEs", "tready", query_dtes),
+    ("Citas", "dwh", query_citas),
+    ("Errores", "tready", query_errores),
+    ("Transacciones", "ap", query_transacciones),
+    ("Emisores", "tready", query_issuers),
+]
+
+# Queries behind --aggregates: Cruce and the company tabs only need per-payment
+# rollups of Citas and DTEs. Errores is already one row per payment and issuer.
+AGGREGATIONS = [
+    ("Citas", "dwh", query_citas_aggregates),
+    ("DTEs", "tready", query_dtes_aggregates),
+    ("Errores", "tready", query_errores),
+]
+
+# db_credentials key and query of every high-water mark, and the cached tabs
+# partitioned by the same day
+WATERMARKS = [
+    ("tready", query_payments_watermarks, ["DTEs", "Errores"]),
+    ("dwh", query_bookings_watermarks, ["Citas"]),
+    ("ap", query_transactions_watermarks, ["Transacciones"]),
+]
+
+# How each extracted tab is ordered by its query: (columns, descending).
+# Citas and Transacciones are ordered by timestamps they only show to the
+# minute or not at all: queries by day or shard return them as a trailing
+# sort_key column that is dropped once the partitions are merged. Citas are
+# ordered like the --aggregates query, so both build Cruce in the same order.
+ORDER_BY = {
+    "DTEs": ([1], True),
+    "Citas": ([12, 0], True),
+    "Errores": ([0, 2], False),
+    "Transacciones": ([6], True),
+}
+SORT_KEYS = {"Citas", "Transacciones"}
+
+# Max open connections per database, which also caps the shards of a database
+# that run at once (see --db-concurrency)
+DB_POOL_SIZE = 5
+db_pool_size = DB_POOL_SIZE
+
+# Rows per fetchmany / sheet write in streaming mode
+STREAM_CHUNK_ROWS = 5000
+# How often a stream worker blocked on a full queue checks whether to give up
+STREAM_POLL_SECONDS = 0.5
 
-def connect_and_fetch_data(query, hostname, username, password, database):
-    conn = psycopg2.connect(host=hostname, user=username, password=password, dbname=database)
-    cur = conn.cursor() 
-    cur.execute(query)
-    rows = cur.fetchall()
-    headers = [desc[0] for desc in cur.description]
-    cur.close()
-    conn.close()
+# Shared by every report built in this process. ThreadedConnectionPool raises
+# when it runs out of connections, so callers wait on a semaphore instead.
+connection_pools = {}
+connection_slots = {}
+connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_key):
+    with connection_pools_lock:
+        if db_key not in connection_pools:
+            credentials = get_db_credentials()[db_key]
+            connection_pools[db_key] = pool.ThreadedConnectionPool(
+                1, db_pool_size,
+                host=credentials["host"], user=credentials["user"], password=credentials["pass"], dbname=credentials["db"])
+            connection_slots[db_key] = threading.BoundedSemaphore(db_pool_size)
+        return connection_pools[db_key], connection_slots[db_key]
+
+@contextlib.contextmanager
+def pooled_connection(db_key):
+    connection_pool, slots = get_connection_pool(db_key)
+    with slots:
+        conn = connection_pool.getconn()
+        try:
+            yield conn
+        except BaseException:
+            # A connection that failed mid-query may be broken or in an aborted
+            # transaction, so it is closed instead of handed to the next query
+            connection_pool.putconn(conn, close=True)
+            raise
+        connection_pool.putconn(conn)
+
+def close_connection_pools():
+    with connection_pools_lock:
+        for connection_pool in connection_pools.values():
+            connection_pool.closeall()
+        connection_pools.clear()
+        connection_slots.clear()
+
+def connect_and_fetch_data(query, db_key):
+    sql, params = query
+    with tracer.span('db.query', db=db_key) as span, pooled_connection(db_key) as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        headers = [desc[0] for desc in cur.description]
+        cur.close()
+        conn.rollback()
+        span['rows'] = len(rows)
 
     return [rows, headers]
 
-tabs = {}
-def load_existing_tabs():
+def stream_rows(conn, query, chunk_size, lock=None):
+    # Named cursors live on the server, so only chunk_size rows are held at a time.
+    # Yields the headers first and then lists of rows.
+    sql, params = query
+    lock = lock or contextlib.nullcontext()
+    with lock:
+        cur = conn.cursor(name=f"r1_{uuid.uuid4().hex}")
+        cur.itersize = chunk_size
+        cur.execute(sql, params)
+        rows = cur.fetchmany(chunk_size)
+    try:
+        yield [desc[0] for desc in cur.description]
+        while rows:
+            yield rows
+            with lock:
+                rows = cur.fetchmany(chunk_size)
+    finally:
+        # Also runs when the consumer abandons the stream
+        with lock:
+            cur.close()
+
+def stream_data(query, db_key, chunk_size=STREAM_CHUNK_ROWS):
+    with pooled_connection(db_key) as conn:
+        yield from stream_rows(conn, query, chunk_size)
+        conn.rollback()
+
+def prepared_statement(sql, params):
+    # PREPARE takes $n placeholders: named parameters are numbered in order of appearance
+    names = []
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+    text = re.sub(r'%\((\w+)\)s', placeholder, sql)
+    return text, [params[name] for name in names]
+
+class TreadySession:
+    # Runs every tready query of an extraction on one connection. On first use
+    # the payments of the company and date range are filtered once into the
+    # r1_payments temp table; each query is prepared the first time it runs.
+    # Threads share the connection one statement at a time.
+    db_key = 'tready'
+
+    def __init__(self, company_id, date_from, date_to):
+        self.params = query_params(company_id, date_from, date_to)
+        self.lock = threading.Lock()
+        self.prepared = {}
+        self.connection = None
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.conn is None:
+            return
+        try:
+            # Rolling back drops the temp table; prepared statements outlive the
+            # transaction, so they are deallocated before the connection goes back to the pool
+            self.conn.rollback()
+            cur = self.conn.cursor()
+            cur.execute("deallocate all")
+            cur.close()
+            self.conn.rollback()
+        finally:
+            self.connection.__exit__(*exc)
+            self.conn = None
+
+    def open(self):
+        # Called with the lock held
+        if self.conn is not None:
+            return
+        self.connection = pooled_connection(self.db_key)
+        self.conn = self.connection.__enter__()
+        with tracer.span('db.payments', db=self.db_key) as span:
+            cur = self.conn.cursor()
+            cur.execute("""
+    create temporary table r1_payments as
+    select id, payment_id, company_id, paid_at
+    from payments
+    where company_id = %(company_id)s
+    and paid_at >= %(date_from)s
+    and paid_at < %(date_to)s""", self.params)
+            span['rows'] = cur.rowcount
+            cur.execute("create index on r1_payments (id)")
+            cur.execute("analyze r1_payments")
+            cur.close()
+
+    def fetch(self, query):
+        sql, params = query
+        text, values = prepared_statement(sql, params)
+        with tracer.span('db.query', db=self.db_key) as span, self.lock:
+            self.open()
+            cur = self.conn.cursor()
+            if sql not in self.prepared:
+                self.prepared[sql] = f"r1_{len(self.prepared) + 1}"
+                cur.execute(f"prepare {self.prepared[sql]} as {text}")
+            cur.execute(f"execute {self.prepared[sql]} ({', '.join(['%s'] * len(values))})", values)
+            rows = cur.fetchall()
+            headers = [desc[0] for desc in cur.description]
+            cur.close()
+            span['rows'] = len(rows)
+        return [rows, headers]
+
+    def stream(self, query, chunk_size=STREAM_CHUNK_ROWS):
+        with self.lock:
+            self.open()
+        return stream_rows(self.conn, query, chunk_size, self.lock)
+
+def fetch_query(query, db_key, session=None):
+    if session is not None and db_key == session.db_key:
+        return session.fetch(query)
+    return connect_and_fetch_data(query, db_key)
+
+# On-disk cache of extracted rows: one Parquet file per company, tab and day.
+# Days newer than cache_open_days can still change and are always fetched again.
+# Older days keep the high-water mark (see WATERMARKS) they were fetched under
+# and are fetched again when the mark moves, e.g. for a DTE issued or an error
+# resolved long after the payment.
+CACHE_DIR = '.r1_cache'
+cache_enabled = True
+cache_open_days = 2
+cache_ttl_days = None
+
+def parse_date(value):
+    for date_format in ('%Y%m%d', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Fecha inválida: {value}")
+
+def cache_path(company_id, tab, day):
+    return os.path.join(CACHE_DIR, str(company_id), tab, f"{day:%Y%m%d}.parquet")
+
+def cache_is_fresh(path):
+    if not os.path.exists(path):
+        return False
+    if cache_ttl_days is None:
+        return True
+    age = datetime.datetime.now().timestamp() - os.path.getmtime(path)
+    return age < cache_ttl_days * 86400
+
+def cache_mark(mark):
+    return json.dumps(mark).encode()
+
+def read_cache(path):
+    # rows, headers and the mark the day was fetched under, None if it has none
+    import pyarrow.parquet as pq
+    table = pq.read_table(path)
+    columns = table.to_pydict()
+    return [list(row) for row in zip(*columns.values())], list(columns), (table.schema.metadata or {}).get(b'r1_mark')
+
+def write_cache(path, rows, headers, mark=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.table({h: pa.array([row[i] for row in rows]) for i, h in enumerate(headers)})
+    table = table.replace_schema_metadata({b'r1_mark': cache_mark(mark)})
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def clear_cache(company_id):
+    shutil.rmtree(os.path.join(CACHE_DIR, str(company_id)), ignore_errors=True)
+
+def clear_cached_days(company_id, tab, days):
+    for day in days:
+        path = cache_path(company_id, tab, parse_date(day))
+        if os.path.exists(path):
+            os.remove(path)
+
+def sort_rows(tab, rows):
+    columns, descending = ORDER_BY[tab]
+    # None sorts last ascending and first descending, like Postgres. Text sorts
+    # by code point, so query_errores sorts with collate "C" to match
+    return sorted(rows, key=lambda row: [(row[column] is None, row[column]) for column in columns], reverse=descending)
+
+def merge_rows(tab, rows, headers):
+    # Rows of several days or shards, in the order of the whole query
+    rows = sort_rows(tab, rows)
+    if tab in SORT_KEYS:
+        return [[row[:-1] for row in rows], headers[:-1]]
+    return [rows, headers]
+
+def missing_ranges(days):
+    # Groups consecutive days into [start, end) ranges
+    ranges = []
+    for day in days:
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + datetime.timedelta(days=1)
+        else:
+            ranges.append([day, day + datetime.timedelta(days=1)])
+    return ranges
+
+# --shard splits the range of the tabs in ORDER_BY into weeks or months that
+# are fetched in parallel, each on its own connection, and merged back in the
+# order of the query. A shard that fails is retried alone.
+SHARDS = ('week', 'month')
+SHARD_RETRIES = 3
+shard_by = None
+
+def date_shards(start, end):
+    # [start, end) cut on Mondays or on the first day of each month
+    shards = []
+    while start < end:
+        if shard_by == 'week':
+            stop = start + datetime.timedelta(days=7 - start.weekday())
+        else:
+            stop = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        shards.append((start, min(stop, end)))
+        start = stop
+    return shards
+
+def fetch_shard(tab, db_key, query, company_id, start, end, by_day=True):
+    date_from, date_to = f"{start:%Y%m%d}", f"{end:%Y%m%d}"
+    for attempt in range(SHARD_RETRIES + 1):
+        try:
+            if db_key == TreadySession.db_key:
+                # Each shard filters its own payments into r1_payments
+                with TreadySession(company_id, date_from, date_to) as session:
+                    return session.fetch(query(company_id, date_from, date_to, by_day=by_day))
+            return connect_and_fetch_data(query(company_id, date_from, date_to, by_day=by_day), db_key)
+        except psycopg2.Error as error:
+            if attempt == SHARD_RETRIES:
+                raise
+            print(f"'{tab}': falló el tramo {date_from}-{date_to}, reintentando ({str(error).strip()})")
+            time.sleep(min(MAX_BACKOFF, BACKOFF_BASE ** attempt))
+
+def fetch_shards(tab, db_key, query, company_id, ranges):
+    # (start, end, [rows, headers]) of every shard of the ranges, oldest first,
+    # with the trailing sort_key and cache_day columns of queries by day. The
+    # connection slots of the database limit how many run at once; tready
+    # shards leave one to the session extract_data holds for the whole run.
+    shards = [shard for start, end in ranges for shard in date_shards(start, end)]
+    slots = db_pool_size - 1 if db_key == TreadySession.db_key else db_pool_size
+    with ThreadPoolExecutor(max_workers=max(1, min(len(shards), slots))) as executor:
+        futures = [executor.submit(fetch_shard, tab, db_key, query, company_id, start, end) for start, end in shards]
+        return [(start, end, future.result()) for (start, end), future in zip(shards, futures)]
+
+def fetch_range(tab, db_key, query, company_id, date_from, date_to, session=None):
+    first, last = parse_date(date_from), parse_date(date_to)
+    if shard_by is None or tab not in ORDER_BY or first >= last:
+        return fetch_query(query(company_id, date_from, date_to), db_key, session)
+    shards = fetch_shards(tab, db_key, query, company_id, [(first, last)])
+    rows = [row[:-1] for start, end, (shard_rows, headers) in reversed(shards) for row in shard_rows]
+    return merge_rows(tab, rows, shards[0][2][1][:-1])
+
+def fetch_cached(tab, db_key, query, company_id, date_from, date_to, session=None, marks=None):
+    # marks: day -> high-water mark of the tab, as read_watermarks returns them
+    if not cache_enabled or tab not in ORDER_BY:
+        return fetch_range(tab, db_key, query, company_id, date_from, date_to, session)
     try:
-        response = sheets_api.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    except HttpError as err:
-        print(f"An HTTP error occurred: {err}")
+        import pyarrow
+    except ImportError:
+        print("pyarrow no está instalado, se extrae sin caché")
+        return fetch_range(tab, db_key, query, company_id, date_from, date_to, session)
+
+    first, last = parse_date(date_from), parse_date(date_to)
+    days = [first + datetime.timedelta(days=i) for i in range((last - first).days)]
+    if not days:
+        return fetch_query(query(company_id, date_from, date_to), db_key, session)
+    closed_until = datetime.date.today() - datetime.timedelta(days=cache_open_days)
+    marks = marks or {}
 
-    for sheet in response['sheets']:
-        k = sheet['properties']['title']
-        v = sheet['properties']['sheetId']
-        tabs[k] = v
+    partitions = {}
+    headers = None
+    for day in days:
+        path = cache_path(company_id, tab, day)
+        if day < closed_until and cache_is_fresh(path):
+            cached_rows, cached_headers, mark = read_cache(path)
+            # Days cached without a mark, or without the sort_key of their tab, are fetched again too
+            if mark == cache_mark(marks.get(f"{day:%Y%m%d}")) and (tab not in SORT_KEYS or cached_headers[-1:] == ['sort_key']):
+                partitions[day], headers = cached_rows, cached_headers
+
+    missing = [day for day in days if day not in partitions]
+    if missing:
+        print(f"'{tab}': {len(days) - len(missing)} días desde caché, {len(missing)} desde la base de datos")
+    if shard_by is None:
+        fetched = [
+            (start, end, fetch_query(query(company_id, f"{start:%Y%m%d}", f"{end:%Y%m%d}", by_day=True), db_key, session))
+            for start, end in missing_ranges(missing)
+        ]
+    else:
+        fetched = fetch_shards(tab, db_key, query, company_id, missing_ranges(missing))
+    for start, end, (rows, fetched_headers) in fetched:
+        headers = fetched_headers[:-1]
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row[-1], []).append(list(row[:-1]))
+        day = start
+        while day < end:
+            partitions[day] = by_day.get(f"{day:%Y%m%d}", [])
+            if day < closed_until:
+                write_cache(cache_path(company_id, tab, day), partitions[day], headers, marks.get(f"{day:%Y%m%d}"))
+            day += datetime.timedelta(days=1)
 
+    rows = [row for day in sorted(partitions, reverse=True) for row in partitions[day]]
+    return merge_rows(tab, rows, headers)
+
+def fetch_tabs():
+    response = execute_read(get_sheets_api().spreadsheets().get(
+        spreadsheetId=report.spreadsheet_id, fields='sheets.properties(title,sheetId)'))
+    return {sheet['properties']['title']: sheet['properties']['sheetId'] for sheet in response.get('sheets', [])}
+
+def load_existing_tabs():
+    report.tabs.clear()
+    report.tabs.update(fetch_tabs())
+    report.tabs_loaded = True
 
-# Load the credentials from a JSON file
-with open('db_credentials.json') as f:
-    db_credentials = json.load(f)
-    
+def get_tabs():
+    if not report.tabs_loaded:
+        load_existing_tabs()
+    return report.tabs
 
-def load_data(tab, db_key, query):
+# Load the credentials from a JSON file on first use
+db_credentials = None
+def get_db_credentials():
+    global db_credentials
+    with clients_lock:
+        if db_credentials is None:
+            with open('db_credentials.json') as f:
+                db_credentials = json.load(f)
+        return db_credentials
+
+@traced
+def load_data(tab, rows, headers):
     print(f"Cargando '{tab}'")
-    create_tab(tab)
-    rows, headers = connect_and_fetch_data(query, db_credentials[db_key]["host"], db_credentials[db_key]["user"], db_credentials[db_key]["pass"], db_credentials[db_key]["db"])
     values = [headers] + rows
-    body = {
-        'values': values
-    }
-    result = sheets_api.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id, range=tab,
-        valueInputOption='USER_ENTERED', body=body).execute()
+    report.datasets[tab] = Dataset(typed_rows(values))
+    write_tab(tab, values)
 
-def main(company_id, date_from, date_to, url, cruce, fee, report_bhe, first_provider, ruts):
-    global spreadsheet_id, citas
-    spreadsheet_id = get_spreadsheet_id_from_url(url)
-    load_existing_tabs()
+def put_unless_stopped(chunks, item, stop):
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=STREAM_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
 
-    if company_id and date_from and date_to:
-        load_data("DTEs", "tready", query_dtes(company_id, date_from, date_to))
-        load_data("Citas", "dwh", query_citas(company_id, date_from, date_to))
-        load_data("Errores", "tready", query_errores(company_id, date_from, date_to))
-        load_data("Transacciones", "ap", query_transacciones(company_id, date_from, date_to))
-        load_data("Emisores", "tready", query_issuers(company_id, date_from, date_to))
-        
-    read_citas_and_dtes()
-    create_catalogo_tabs()
+def stream_to_queue(tab, db_key, query, chunks, stop, session=None):
+    try:
+        with tracer.span('db.stream', db=db_key, tab=tab) as span:
+            span['rows'] = 0
+            rows = session.stream(query) if session is not None and db_key == session.db_key else stream_data(query, db_key)
+            with contextlib.closing(rows):
+                for i, chunk in enumerate(rows):
+                    # The first chunk is the header row
+                    span['rows'] += len(chunk) if i else 0
+                    if not put_unless_stopped(chunks, (tab, chunk), stop):
+                        return
+        put_unless_stopped(chunks, (tab, None), stop)
+    except Exception as error:
+        put_unless_stopped(chunks, (tab, error), stop)
+
+def extract_data_streaming(company_id, date_from, date_to, session):
+    # Each query streams its chunks through a bounded queue and the main thread
+    # writes them at the next free row, so memory does not grow with the date range
+    chunks = queue.Queue(maxsize=len(EXTRACTIONS) * 2)
+    stop = threading.Event()
+    next_row = {}
+    streamed = {}
+    with ThreadPoolExecutor(max_workers=len(EXTRACTIONS)) as executor:
+        for tab, db_key, query in EXTRACTIONS:
+            executor.submit(stream_to_queue, tab, db_key, query(company_id, date_from, date_to), chunks, stop, session)
+        pending = len(EXTRACTIONS)
+        try:
+            while pending:
+                tab, chunk = chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if chunk is None:
+                    print(f"Cargado '{tab}'")
+                    finish_tab(tab, next_row[tab] - 1)
+                    if tab in streamed:
+                        report.datasets[tab] = Dataset(streamed.pop(tab))
+                    pending -= 1
+                    continue
+                if tab not in next_row:
+                    print(f"Cargando '{tab}'")
+                    next_row[tab] = 1
+                    chunk = [chunk]
+                if report.sink.local:
+                    # The builders read the extracted tabs back from memory
+                    streamed.setdefault(tab, []).extend(typed_rows(chunk))
+                write_rows(tab, chunk, row=next_row[tab])
+                next_row[tab] += len(chunk)
+        finally:
+            # On an error the workers still streaming would block on the full
+            # queue and the executor would wait for them forever: tell them to
+            # stop and empty the queue so they can close their cursors
+            stop.set()
+            while True:
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    break
+
+@traced
+def extract_data(company_id, date_from, date_to, stream=False):
+    # New tabs are created up front so their order does not depend on which
+    # query finishes first. Existing tabs are only cleared once their rows are
+    # known to have changed.
+    created = set()
+    for tab, db_key, query in EXTRACTIONS:
+        if stream or report.journal is None or tab not in get_tabs():
+            create_tab(tab)
+            created.add(tab)
+
+    with TreadySession(company_id, date_from, date_to) as session:
+        if stream:
+            # Streamed rows are written before they can be hashed
+            if report.journal is not None:
+                for tab, db_key, query in EXTRACTIONS:
+                    report.journal.forget(tab)
+            extract_data_streaming(company_id, date_from, date_to, session)
+            return
+
+        # Read before the rows, so a change in between only makes the next run fetch its day again
+        marks = read_watermarks(company_id, date_from, date_to) if cache_enabled else {}
+        with ThreadPoolExecutor(max_workers=len(EXTRACTIONS)) as executor:
+            futures = {
+                executor.submit(fetch_cached, tab, db_key, query, company_id, date_from, date_to, session, marks.get(tab)): tab
+                for tab, db_key, query in EXTRACTIONS
+            }
+            for future in as_completed(futures):
+                rows, headers = future.result()
+                tab = futures[future]
+                if tab_unchanged(tab, company_id, date_from, date_to, headers, rows):
+                    report.datasets[tab] = Dataset(typed_rows([headers] + rows))
+                    continue
+                if tab not in created:
+                    create_tab(tab)
+                load_data(tab, rows, headers)
+
+@traced
+def fetch_aggregates(company_id, date_from, date_to):
+    with TreadySession(company_id, date_from, date_to) as session, ThreadPoolExecutor(max_workers=len(AGGREGATIONS)) as executor:
+        futures = {
+            tab: executor.submit(fetch_query, query(company_id, date_from, date_to), db_key, session)
+            for tab, db_key, query in AGGREGATIONS
+        }
+        results = {tab: future.result() for tab, future in futures.items()}
+    report.aggregates = {tab: pd.DataFrame(rows, columns=headers) for tab, (rows, headers) in results.items()}
+    # Errores is read like the extracted tab
+    rows, headers = results['Errores']
+    report.datasets['Errores'] = Dataset(typed_rows([headers] + rows))
+    print(f"Agregados: {len(results['Citas'][0])} filas de citas y {len(results['DTEs'][0])} de DTEs")
+
+def configure(no_cache=False, cache_ttl=None, read_quota=READS_PER_MINUTE, write_quota=WRITES_PER_MINUTE, sheets_concurrency=SHEETS_CONCURRENCY,
+              workers=PROVIDER_WORKERS, shard=None, db_concurrency=DB_POOL_SIZE, transport='urllib3', gzip_requests=False):
+    # Settings shared by every report built in this process
+    global cache_enabled, cache_ttl_days, sheets_scheduler, provider_workers, shard_by, db_pool_size
+    if shard and db_concurrency < 2:
+        raise Exception("--shard requiere --db-concurrency de 2 o más: la extracción mantiene una conexión a tready abierta")
+    cache_enabled = not no_cache
+    cache_ttl_days = cache_ttl
+    provider_workers = max(1, workers)
+    shard_by = shard
+    db_pool_size = max(1, db_concurrency)
+    sheets_scheduler = SheetsScheduler(read_quota, write_quota, sheets_concurrency, transport, gzip_requests)
 
+def build_report(company_id, date_from, date_to, url, cruce, fee, report_bhe, first_provider, ruts, materialize=False, formulas=False, stream=False,
+                 incremental_update=False, refresh_cache=False, output='sheets', output_path=None, aggregates=False, array_formulas=False,
+                 rebuild=False):
+    report.activate(ReportState(get_spreadsheet_id_from_url(url) if url else None, incremental_update))
+    report.sink = make_sink(output, output_path)
     if (cruce or ruts or report_bhe) and not fee:
         raise Exception("Se requiere indicar el fee del prestador con la opción -f o --fee")
+    if not url and not (report.sink.local and company_id and date_from and date_to):
+        raise Exception("Se requiere --url, salvo al extraer datos hacia una salida local")
+    if report.sink.local:
+        # Local files have no formulas and no previous version to patch
+        materialize, formulas, array_formulas = True, False, False
+        report.incremental = False
+    if array_formulas:
+        formulas = True
+    if aggregates and formulas:
+        raise Exception("--aggregates escribe el cruce y las hojas por local como valores, no se usa con --formulas ni --array-formulas")
+    if not report.sink.local and not rebuild:
+        report.journal = RunJournal(report.spreadsheet_id)
+        report.write_buffer.on_flush.append(report.journal.flushed)
+    if refresh_cache and company_id:
+        clear_cache(company_id)
+    if url:
+        load_existing_tabs()
+
+    if aggregates:
+        build_aggregated_report(company_id, date_from, date_to, cruce, report_bhe, ruts)
+        return
+
+    if company_id and date_from and date_to:
+        extract_data(company_id, date_from, date_to, stream)
+
+    read_citas_and_dtes()
+    create_catalogo_tabs()
 
     if report_bhe or ruts or cruce:
-        create_cruce_basico()
+        create_cruce_basico(formulas, array_formulas)
 
     if ruts:
-        create_company_tabs(ruts)
+        create_company_tabs(ruts, formulas, array_formulas)
 
     if report_bhe:
-        if citas:
-            create_and_copy_rows_to_tabs(fee, first_provider)
+        if report.citas:
+            create_and_copy_rows_to_tabs(fee, first_provider, materialize, array_formulas)
         else:
             print("No data found in the source tab.")
 
+    report.sink.close()
+
+PROFILE_FILE = 'r1_profile.json'
+
+def start_profiling(python_profile=False, memory_profile=False):
+    tracer.enable()
+    if memory_profile:
+        tracemalloc.start(10)
+    if python_profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    return None
+
+def finish_profiling(path, profiler=None):
+    other_data = {}
+    if profiler:
+        # cProfile only sees the main thread, where the builders run
+        profiler.disable()
+        profiler.dump_stats(os.path.splitext(path)[0] + '.prof')
+        stats = io.StringIO()
+        pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(25)
+        print(stats.getvalue())
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:15]
+        tracemalloc.stop()
+        other_data['tracemalloc'] = {
+            'peak_bytes': peak,
+            'top': [{'where': str(stat.traceback), 'bytes': stat.size, 'count': stat.count} for stat in top],
+        }
+        print(f"Memoria Python: máximo {peak / 2 ** 20:.1f} MB")
+        for stat in top[:5]:
+            print(f"  {stat.size / 2 ** 20:8.1f} MB  {stat.traceback}")
+    tracer.dump(path, other_data)
+    print(tracer.table())
+    print(f"Traza escrita en '{path}'")
+
+def build_aggregated_report(company_id, date_from, date_to, cruce, report_bhe, ruts):
+    # Cruce and the company tabs from SQL rollups, without the raw tabs. Catalogo
+    # and the provider tabs list every booking, so they still need --company-id
+    # extraction without --aggregates.
+    if not (company_id and date_from and date_to):
+        raise Exception("--aggregates requiere --company-id, --date-from y --date-to")
+    if report_bhe:
+        raise Exception("Las hojas por prestador necesitan las filas de Citas, no se pueden crear con --aggregates")
+    fetch_aggregates(company_id, date_from, date_to)
+    print("Catalogo necesita las filas de Citas y DTEs, se omite con --aggregates")
+
+    if ruts or cruce:
+        create_cruce_basico()
+
+    if ruts:
+        create_company_tabs(ruts)
+
+    report.sink.close()
+
+# --watch keeps the process, its DB connection pools and the Sheets client
+# alive and polls the high-water marks every interval. The report is built
+# again only when a mark moves: the days whose marks moved are dropped from the
+# extraction cache, so only they and the open days are fetched again, and the
+# journal and the row hashes leave the unchanged tabs and rows as they are.
+WATCH_INTERVAL = 60.0
+
+def watermarks_path(spreadsheet_id):
+    return os.path.join(STATE_DIR, spreadsheet_id, 'watermarks.json')
+
+def read_watermarks(company_id, date_from, date_to):
+    # Tab -> day -> mark
+    marks = {}
+    with ThreadPoolExecutor(max_workers=len(WATERMARKS)) as executor:
+        futures = [
+            (tabs, executor.submit(connect_and_fetch_data, query(company_id, date_from, date_to), db_key))
+            for db_key, query, tabs in WATERMARKS
+        ]
+        for tabs, future in futures:
+            rows, headers = future.result()
+            days = {row[0]: [cell_text(v) for v in row[1:]] for row in rows}
+            for tab in tabs:
+                marks[tab] = days
+    return marks
+
+def changed_days(old, new):
+    return {
+        tab: sorted(day for day in set(old.get(tab, {})) | set(days) if old.get(tab, {}).get(day) != days.get(day))
+        for tab, days in new.items()
+    }
+
+def watch_report(spreadsheet_id, company_id, date_from, date_to, interval, build):
+    # build(first) builds the report once; first is True on the first cycle
+    path = watermarks_path(spreadsheet_id)
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+    first = True
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                marks = read_watermarks(company_id, date_from, date_to)
+                if first or marks != saved:
+                    # Marks saved by an earlier process also tell which cached days went stale meanwhile
+                    changes = changed_days(saved, marks) if saved is not None else {}
+                    for tab, days in changes.items():
+                        clear_cached_days(company_id, tab, days)
+                    build(first)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'w') as f:
+                        json.dump(marks, f)
+                    saved = marks
+                    first = False
+                    days = sorted(set(day for tab_days in changes.values() for day in tab_days))
+                    print(f"{datetime.datetime.now():%H:%M:%S} reporte actualizado en {time.monotonic() - started:.1f}s"
+                          + (f", días con cambios: {', '.join(days)}" if days else ""))
+                else:
+                    print(f"{datetime.datetime.now():%H:%M:%S} sin cambios")
+            except Exception:
+                # A failed cycle keeps the old marks, so the next one retries it
+                traceback.print_exc()
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print("Modo --watch detenido")
+
+def main(company_id, date_from, date_to, url, cruce, fee, report_bhe, first_provider, ruts, materialize=False, formulas=False, stream=False,
+         no_cache=False, cache_ttl=None, refresh_cache=False, incremental_update=False,
+         read_quota=READS_PER_MINUTE, write_quota=WRITES_PER_MINUTE, sheets_concurrency=SHEETS_CONCURRENCY,
+         output='sheets', output_path=None, profile=None, python_profile=False, memory_profile=False, aggregates=False,
+         array_formulas=False, workers=PROVIDER_WORKERS, rebuild=False, watch=None, shard=None, db_concurrency=DB_POOL_SIZE,
+         transport='urllib3', gzip_requests=False):
+    configure(no_cache, cache_ttl, read_quota, write_quota, sheets_concurrency, workers, shard, db_concurrency, transport, gzip_requests)
+    profiler = start_profiling(python_profile, memory_profile) if profile else None
+    try:
+        if watch:
+            # Every cycle only patches the rows that changed; --rebuild and --refresh-cache apply to the first one
+            watch_report(get_spreadsheet_id_from_url(url), company_id, date_from, date_to, watch, lambda first: build_report(
+                company_id, date_from, date_to, url, cruce, fee, report_bhe, first_provider, ruts, materialize, formulas, stream,
+                True, refresh_cache and first, output, output_path, aggregates, array_formulas, rebuild and first))
+        else:
+            build_report(company_id, date_from, date_to, url, cruce, fee, report_bhe, first_provider, ruts, materialize, formulas, stream,
+                         incremental_update, refresh_cache, output, output_path, aggregates, array_formulas, rebuild)
+    finally:
+        close_connection_pools()
+        if profile:
+            finish_profiling(profile, profiler)
+    print(sheets_scheduler.summary())
+
+def build_manifest_entry(entry, defaults):
+    options = {**defaults, **entry}
+    build_report(options.get('company_id'), options.get('date_from'), options.get('date_to'), options.get('url'),
+                 options.get('cruce', False), options.get('fee'), options.get('report_bhe', False), options.get('skip_until'),
+                 options.get('ruts'), options.get('materialize', False), options.get('formulas', False), options.get('stream', False),
+                 options.get('incremental', False), options.get('refresh_cache', False),
+                 options.get('output', 'sheets'), options.get('output_path'), options.get('aggregates', False),
+                 options.get('array_formulas', False), options.get('rebuild', False))
+
+def run_batch(manifest, workers, defaults):
+    # Builds every report of the manifest on a pool of workers that share the
+    # DB connection pools and the Sheets quota. A failing company is reported
+    # and does not stop the others.
+    with open(manifest) as f:
+        entries = json.load(f)
+
+    def run_entry(entry):
+        started = time.monotonic()
+        try:
+            build_manifest_entry(entry, defaults)
+            return 'ok', time.monotonic() - started, ''
+        except Exception as error:
+            traceback.print_exc()
+            return 'error', time.monotonic() - started, str(error)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_entry, entries))
+    finally:
+        close_connection_pools()
+
+    print(f"{'company_id':<12} {'estado':<7} {'segundos':>9}  detalle")
+    for entry, (status, elapsed, detail) in zip(entries, results):
+        print(f"{str(entry.get('company_id', '')):<12} {status:<7} {elapsed:>9.1f}  {detail or entry.get('url') or entry.get('output_path', '')}")
+    print(sheets_scheduler.summary())
+    return all(status == 'ok' for status, elapsed, detail in results)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generador de reportes de Tready')
-    parser.add_argument('-u',  '--url',          type=str, required=True, help='URL del reporte sin incluir /edit#gid=...')
+    parser.add_argument('-u',  '--url',          type=str,                help='URL del reporte sin incluir /edit#gid=...')
     parser.add_argument('-c',  '--cruce',        action='store_true',     help='Calcular cruce general')
     parser.add_argument('-f',  '--fee',          type=float,              help='Comisión del prestador')
     parser.add_argument('-re', '--ruts-empresa', nargs='+',               help='RUTs de empresa y nombres de local en formato RUT/Location')
     parser.add_argument('-bh', '--report-bhe',   action='store_true',     help='Crear hojas por prestador')
     parser.add_argument('-s',  '--skip-until',   type=str,                help='Comenzar con este prestador')
+    parser.add_argument('-pw', '--provider-workers', type=int, default=PROVIDER_WORKERS, help='Hojas por prestador que se preparan a la vez')
     parser.add_argument('-ci', '--company-id',   type=str,                help='Extraer datos de Company ID')
     parser.add_argument('-df', '--date-from',    type=str,                help='Extraer desde en formato yyyyMMdd')
     parser.add_argument('-dt', '--date-to',      type=str,                help='Extraer hasta (no inclusivo) en formato yyyyMMdd')
+    parser.add_argument('-m',  '--materialize',  action='store_true',     help='Escribir valores calculados en vez de fórmulas en las hojas por prestador')
+    parser.add_argument('-fx', '--formulas',     action='store_true',     help='Escribir cruce y hojas por local con fórmulas en vez de valores calculados')
+    parser.add_argument('-af', '--array-formulas', action='store_true',   help='Con fórmulas, escribir una sola fórmula por columna (ARRAYFORMULA) en vez de una por fila')
+    parser.add_argument('-st', '--stream',       action='store_true',     help='Extraer por partes con cursores del servidor, sin guardar los datos en memoria')
+    parser.add_argument('-nc', '--no-cache',     action='store_true',     help='No usar la caché local de datos extraídos')
+    parser.add_argument('-ct', '--cache-ttl',    type=float,              help='Días que se considera válido un día guardado en caché')
+    parser.add_argument('-rc', '--refresh-cache', action='store_true',    help='Borrar la caché de la empresa antes de extraer')
+    parser.add_argument('-sh', '--shard',        type=str, choices=SHARDS, help='Extraer Citas, DTEs, Errores y Transacciones en tramos de una semana o un mes que se consultan en paralelo')
+    parser.add_argument('-dc', '--db-concurrency', type=int, default=DB_POOL_SIZE, help='Conexiones simultáneas por base de datos (al menos 2 con --shard)')
+    parser.add_argument('-rb', '--rebuild',      action='store_true',     help='Reescribir todas las hojas aunque sus datos no hayan cambiado desde la ejecución anterior')
+    parser.add_argument('-i',  '--incremental',  action='store_true',     help='Actualizar sólo las filas que cambiaron en las hojas existentes')
+    parser.add_argument('-wa', '--watch',        type=float, nargs='?', const=WATCH_INTERVAL,
+                        help='Seguir corriendo y actualizar el reporte cuando cambien citas, pagos, DTEs o transacciones, revisando cada N segundos (60 por defecto)')
+    parser.add_argument('-rq', '--read-quota',   type=int, default=READS_PER_MINUTE,   help='Lecturas por minuto permitidas en la API de Sheets')
+    parser.add_argument('-wq', '--write-quota',  type=int, default=WRITES_PER_MINUTE,  help='Escrituras por minuto permitidas en la API de Sheets')
+    parser.add_argument('-sc', '--sheets-concurrency', type=int, default=SHEETS_CONCURRENCY, help='Escrituras simultáneas a la API de Sheets')
+    parser.add_argument('-tr', '--transport',    type=str, default='urllib3', choices=TRANSPORTS, help='Conexiones a Sheets: urllib3 las reutiliza entre hilos, httplib2 abre una por hilo')
+    parser.add_argument('-gz', '--gzip-requests', action='store_true',    help='Enviar comprimidas con gzip las llamadas grandes a Sheets')
+    parser.add_argument('-o',  '--output',       type=str, default='sheets', choices=list(OUTPUTS), help='Dónde escribir el reporte: la planilla o archivos locales')
+    parser.add_argument('-op', '--output-path',  type=str,                help='Archivo .xlsx o carpeta para parquet/csv (por defecto reporte.xlsx o reporte/)')
+    parser.add_argument('-ag', '--aggregates',   action='store_true',     help='Calcular cruce y hojas por local con consultas agregadas, sin extraer las pestañas de datos')
+    parser.add_argument('-p',  '--profile',      type=str, nargs='?', const=PROFILE_FILE, help='Guardar una traza JSON con tiempos por etapa y mostrar un resumen')
+    parser.add_argument('-cp', '--cprofile',     action='store_true',     help='Con --profile, perfilar también el código Python con cProfile')
+    parser.add_argument('-tm', '--tracemalloc',  action='store_true',     help='Con --profile, medir la memoria Python con tracemalloc')
+    parser.add_argument('-b',  '--batch',        type=str,                help='Archivo JSON con una lista de reportes (company_id, url, date_from, date_to, fee, ruts, ...)')
+    parser.add_argument('-w',  '--workers',      type=int, default=4,     help='Reportes simultáneos en modo batch')
 
     args = parser.parse_args()
-    main(args.company_id, args.date_from, args.date_to, args.url, args.cruce, args.fee, args.report_bhe, args.skip_until, args.ruts_empresa)
+    if (args.cprofile or args.tracemalloc) and not args.profile:
+        args.profile = PROFILE_FILE
+    if args.watch and (args.batch or not (args.url and args.output == 'sheets' and args.company_id and args.date_from and args.date_to)):
+        parser.error('--watch requiere --url, --company-id, --date-from y --date-to, escribe en la planilla y no se usa con --batch')
+    if args.batch:
+        configure(args.no_cache, args.cache_ttl, args.read_quota, args.write_quota, args.sheets_concurrency, args.provider_workers,
+                  args.shard, args.db_concurrency, args.transport, args.gzip_requests)
+        profiler = start_profiling(args.cprofile, args.tracemalloc) if args.profile else None
+        defaults = {
+            'cruce': args.cruce, 'fee': args.fee, 'report_bhe': args.report_bhe, 'materialize': args.materialize,
+            'formulas': args.formulas, 'stream': args.stream, 'incremental': args.incremental, 'refresh_cache': args.refresh_cache,
+            'output': args.output, 'aggregates': args.aggregates, 'array_formulas': args.array_formulas,
+            'rebuild': args.rebuild,
+        }
+        ok = run_batch(args.batch, args.workers, defaults)
+        if args.profile:
+            finish_profiling(args.profile, profiler)
+        sys.exit(0 if ok else 1)
+    if not args.url and args.output == 'sheets':
+        parser.error('se requiere --url (o --batch)')
+    main(args.company_id, args.date_from, args.date_to, args.url, args.cruce, args.fee, args.report_bhe, args.skip_until, args.ruts_empresa, args.materialize, args.formulas, args.stream,
+         args.no_cache, args.cache_ttl, args.refresh_cache, args.incremental,
+         args.read_quota, args.write_quota, args.sheets_concurrency, args.output, args.output_path,
+         args.profile, args.cprofile, args.tracemalloc, args.aggregates, args.array_formulas, args.provider_workers, args.rebuild,
+         args.watch, args.shard, args.db_concurrency, args.transport, args.gzip_requests)